@@ -0,0 +1,89 @@
+#! /usr/bin/env python3
+import argparse
+import os
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from globals import tools_dir, project_name
+from split import iter_statements
+
+
+def load_statements(search_dir: str) -> list:
+    """
+    Load every IF/THEN statement of the scripts in a directory.
+    :param search_dir: The directory holding the .BAF files.
+    :return: A list of statement strings.
+    """
+    result = []
+    for file_name in sorted(os.listdir(search_dir)):
+        if file_name.lower().endswith('.baf'):
+            with open(os.path.join(search_dir, file_name)) as fp:
+                result += list(iter_statements(fp))
+    return result
+
+
+def generate_corpus(target_dir: str, statements: list, line_count: int,
+                    lines_per_script: int = 10000) -> int:
+    """
+    Write a synthetic corpus of scripts built from real statements.  Each
+    script gets its own string IDs so that lines differ between scripts,
+    the way scripts from different mods do.
+    :param target_dir: Where to write the scripts.
+    :param statements: The statements to draw from.
+    :param line_count: The number of lines to write (at least).
+    :param lines_per_script: Roughly how many lines go in each script.
+    :return: The number of lines written.
+    """
+    r_string = re.compile(r"(DisplayString\([^,]*,)(\d+)\)")
+    written = 0
+    script = 0
+    while written < line_count:
+        script += 1
+        path = os.path.join(target_dir, "MOD{:03}".format(script // 20),
+                            "SCRIPT{:04}.BAF".format(script))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        lines = 0
+        with open(path, "w") as fp:
+            for statement in statements:
+                if lines >= lines_per_script or written >= line_count:
+                    break
+                statement = r_string.sub(
+                    lambda m: "{}{})".format(
+                        m.group(1), int(m.group(2)) + script * 100000),
+                    statement)
+                fp.write(statement)
+                fp.write("\n\n")
+                count = statement.count("\n") + 2
+                lines += count
+                written += count
+    return written
+
+
+if __name__ == "__main__":
+    search_dir = os.path.join(tools_dir, "..", project_name)
+    parser = argparse.ArgumentParser(
+        description="Measure corpus mode peak RSS on a synthetic corpus")
+    parser.add_argument('-l', '--lines', type=int, default=1000000)
+    parser.add_argument('-d', '--search_dir', default=search_dir)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        statements = load_statements(args.search_dir)
+        lines = generate_corpus(temp_dir, statements, args.lines)
+        print("Generated {} lines from {} statements".format(
+            lines, len(statements)))
+
+        start = time.time()
+        subprocess.check_call([sys.executable,
+                               os.path.join(tools_dir, "corpus.py"),
+                               "-o", os.devnull, temp_dir])
+        elapsed = time.time() - start
+
+    # ru_maxrss is in kilobytes on Linux.
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    print("Corpus mode: {:.1f}s, peak RSS {:.1f} MB".format(
+        elapsed, peak / 1024.0))
@@ -0,0 +1,60 @@
+#! /usr/bin/env python3
+import argparse
+import os
+import statistics
+import time
+
+from combine import convert_json_to_blocks, convert_row_to_block, \
+    load_snippets, row_count, snippet_rows
+from globals import tools_dir, project_name
+from registry import TemplateRegistry
+
+
+def time_call(function, runs: int) -> float:
+    """
+    :return: The median time of calling function, in seconds.
+    """
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def render_rows(snippet: dict, registry: TemplateRegistry) -> list:
+    """
+    Render a snippet one row at a time, the way combine did before render
+    plans.
+    """
+    return [convert_row_to_block(snippet, fields, registry)
+            for fields in snippet_rows(snippet)]
+
+
+if __name__ == "__main__":
+    search_dir = os.path.join(tools_dir, "..", project_name)
+    parser = argparse.ArgumentParser(
+        description="Compare row-by-row rendering with render plans")
+    parser.add_argument('-d', '--search_dir', default=search_dir)
+    parser.add_argument('-n', '--runs', type=int, default=20)
+    parser.add_argument('-c', '--count', type=int, default=5,
+                        help="How many of the largest snippets to time")
+    parser.add_argument('target', nargs='?', default="X_ALL")
+    args = parser.parse_args()
+
+    registry = TemplateRegistry.load(args.search_dir)
+    snippets = load_snippets(os.path.join(args.search_dir, args.target))
+    largest = sorted(snippets, key=row_count,
+                     reverse=True)[:args.count]
+
+    print("{:<32} {:>5} {:>10} {:>10} {:>8}".format(
+        "snippet", "rows", "rows ms", "plan ms", "speedup"))
+    for label, items in [(item.get("name", "<unnamed>"), [item])
+                         for item in largest] + [("(all)", snippets)]:
+        slow = time_call(lambda: [render_rows(item, registry)
+                                  for item in items], args.runs)
+        fast = time_call(lambda: [convert_json_to_blocks(item, registry)
+                                  for item in items], args.runs)
+        print("{:<32} {:>5} {:>10.2f} {:>10.2f} {:>7.1f}x".format(
+            label, sum(row_count(item) for item in items),
+            slow * 1000, fast * 1000, slow / fast))
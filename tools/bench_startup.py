@@ -0,0 +1,160 @@
+#! /usr/bin/env python3
+import argparse
+import compileall
+import io
+import json
+import os
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+
+from globals import tools_dir, project_name
+
+
+def time_command(command: list) -> tuple:
+    """
+    Run a command once.
+    :param command: The command line.
+    :return: The (wall, cpu) time of the run, in seconds.
+    """
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.perf_counter()
+    subprocess.check_call(command)
+    wall = time.perf_counter() - start
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = after.ru_utime + after.ru_stime - \
+        before.ru_utime - before.ru_stime
+    return wall, cpu
+
+
+def time_commands(commands: list, runs: int) -> list:
+    """
+    Run several commands in turn, round after round, so that a change in
+    machine load affects all of them alike.
+    :param commands: The command lines.
+    :param runs: How many times to run each.
+    :return: For each command, the (wall, cpu) time of each run.
+    """
+    result = [[] for _ in commands]
+    for _ in range(runs):
+        for times, command in zip(result, commands):
+            times.append(time_command(command))
+    return result
+
+
+def report(label: str, times: list, startup: float = 0.0) -> float:
+    """
+    Print the median times of a command.
+    :param label: What was run.
+    :param times: The time_command result.
+    :param startup: The median wall time of a bare interpreter, in seconds.
+    :return: The median wall time, in seconds.
+    """
+    wall = statistics.median(item[0] for item in times)
+    cpu = statistics.median(item[1] for item in times)
+    print("{:<24} wall median {:6.1f} ms   cpu median {:6.1f} ms   "
+          "beyond startup {:6.1f} ms".format(
+              label, wall * 1000, cpu * 1000, (wall - startup) * 1000))
+    return wall
+
+
+def extract_tools(revision: str, target_dir: str) -> str:
+    """
+    Extract the tools of a git revision.
+    :param revision: The revision, such as a commit hash.
+    :param target_dir: The directory to extract into.
+    :return: target_dir.
+    """
+    archive = subprocess.check_output(
+        ["git", "-C", os.path.join(tools_dir, ".."), "archive",
+         "{}:tools".format(revision)])
+    with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+        tar.extractall(target_dir)
+    return target_dir
+
+
+def copy_project(search_dir: str, target: str, project: str,
+                 expand: bool = False):
+    """
+    Copy the templates and one script of a project, so that a combine of
+    the whole copy builds only that script.
+    :param search_dir: The project directory.
+    :param target: The script, such as X_PICK.
+    :param project: The directory to create.
+    :param expand: If True, write every snippet's rows as a "fields"
+    list, the only form tools before compact rows can read.
+    """
+    os.makedirs(project)
+    for name in ("if", "then", target):
+        shutil.copytree(os.path.join(search_dir, name),
+                        os.path.join(project, name))
+    shutil.copy(os.path.join(search_dir, target + ".BAF"), project)
+    if not expand:
+        return
+    from combine import list_snippets, snippet_rows
+    for path in list_snippets(os.path.join(project, target)):
+        with open(path) as fp:
+            snippet = json.load(fp)
+        if "rows" in snippet:
+            snippet["fields"] = snippet_rows(snippet)
+            del snippet["rows"]
+            snippet.pop("shared", None)
+            with open(path, "w") as fp:
+                json.dump(snippet, fp, indent=4, sort_keys=True)
+
+
+if __name__ == "__main__":
+    search_dir = os.path.join(tools_dir, "..", project_name)
+    parser = argparse.ArgumentParser(
+        description="Measure combine.py cold start on a single target")
+    parser.add_argument('-d', '--search_dir', default=search_dir)
+    parser.add_argument('-n', '--runs', type=int, default=20)
+    parser.add_argument('-b', '--baseline',
+                        help="Git revision to compare against (default: the "
+                             "first commit)")
+    parser.add_argument('target', nargs='?', default="X_PICK")
+    args = parser.parse_args()
+
+    baseline = args.baseline or subprocess.check_output(
+        ["git", "-C", tools_dir, "rev-list", "--max-parents=0", "HEAD"],
+        universal_newlines=True).split()[0]
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        project = os.path.join(temp_dir, "project")
+        copy_project(args.search_dir, args.target, project)
+        # The baseline reads its templates from tools/../xseries.
+        old_project = os.path.join(temp_dir, "old", project_name)
+        copy_project(args.search_dir, args.target, old_project, True)
+        old_tools = extract_tools(baseline,
+                                  os.path.join(temp_dir, "old", "tools"))
+
+        combine = [sys.executable, os.path.join(tools_dir, "combine.py"),
+                   "-d", project, args.target]
+        old_combine = [sys.executable, os.path.join(old_tools, "combine.py"),
+                       "-d", old_project]
+
+        # Byte-compile both trees, as an installed copy would be, even if
+        # PYTHONDONTWRITEBYTECODE is set.  The script itself never is.
+        for directory in (tools_dir, old_tools):
+            compileall.compile_dir(directory, quiet=1)
+        # The first run builds the cache.
+        time_command(combine)
+        labels = ["python (no script)", "baseline {}".format(baseline[:7]),
+                  "combine.py --no_cache", "combine.py (cached)"]
+        results = time_commands(
+            [[sys.executable, "-c", "pass"], old_combine,
+             combine + ["--no_cache"], combine], args.runs)
+        startup = statistics.median(item[0] for item in results[0])
+        walls = [report(label, times, startup)
+                 for label, times in zip(labels, results)]
+        # The template cache is within noise of --no_cache here, so both
+        # are compared with the baseline.
+        for label, wall in zip(labels[2:], walls[2:]):
+            print("Beyond interpreter startup, {} takes {:.0f}% of the "
+                  "baseline's time".format(
+                      label, 100 * (wall - startup) / (walls[1] - startup)))
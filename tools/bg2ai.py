@@ -0,0 +1,24 @@
+#! /usr/bin/env python3
+"""
+The split/combine tools as a library.
+
+Everything here works on text and snippet dicts in memory and takes its
+templates from an explicit TemplateRegistry, so one process can work on
+several projects at once:
+
+    registry = TemplateRegistry("path/to/xseries")
+    snippets = collapse(parse_baf(text), registry)
+    text = render(snippets, registry)
+"""
+from combine import load_snippets, render
+from registry import TemplateRegistry
+from split import collapse, iter_collapse, parse_baf
+
+__all__ = [
+    "TemplateRegistry",
+    "collapse",
+    "iter_collapse",
+    "load_snippets",
+    "parse_baf",
+    "render",
+]
@@ -1,18 +1,17 @@
 #! /usr/bin/env python3
 import argparse
 import collections
-from copy import deepcopy
 import json
 import logging
 import os
-from pprint import pprint, pformat
 import re
-import shutil
 import sys
 
-from substituter import Substituter
-from globals import tools_dir, project_name
+from globals import LazyFormat, tools_dir, project_name
+from registry import TemplateRegistry
 
+# The manifest of shared snippets, kept in the project directory.
+manifest_name = "manifest.json"
 
 
 def replace_single_quotes_with_double_outside_comment(data: str) -> str:
@@ -20,7 +19,7 @@ def replace_single_quotes_with_double_outside_comment(data: str) -> str:
     Replace single quotes in non-comment with double quotes.
     Returns the string with replacements
     """
-    logging.debug("rsq: {}".format(pformat(data)))
+    logging.debug("rsq: %s", LazyFormat(data))
     r = re.compile(r"^(.*)\/\/.*$|^(.*)$", re.MULTILINE)
     matches = [m.span(m.lastindex) for m in r.finditer(data)]
     for start, end in matches:
@@ -32,12 +31,14 @@ def replace_single_quotes_with_double_outside_comment(data: str) -> str:
     return data
 
 
-def convert_actions_to_text(weight: int, actions: list, fields_in: dict) -> list:
+def convert_actions_to_text(weight: int, actions: list, fields_in: dict,
+                            registry: TemplateRegistry) -> list:
     """
     Convert a list of actions into a list of strings.
     :param weight: The weight of the response block.
     :param actions: The list of actions for that weight.
     :param fields_in: A dict of field values.
+    :param registry: The templates to expand.
     :return: a list of strings.
     """
     lines = ["RESPONSE #{}".format(weight)]
@@ -51,7 +52,7 @@ def convert_actions_to_text(weight: int, actions: list, fields_in: dict) -> list
             else:
                 value = fields_in
 
-            template = Substituter(key)
+            template = registry.substituter(key)
             template_lines = template.expand(value)
             for template_line in template_lines:
                 lines.append('\t' + template_line)
@@ -73,11 +74,14 @@ def convert_actions_to_text(weight: int, actions: list, fields_in: dict) -> list
     return out
 
 
-def convert_triggers_to_text(source_in: list, fields_in: dict, in_or: bool=False) -> list:
+def convert_triggers_to_text(source_in: list, fields_in: dict,
+                             registry: TemplateRegistry,
+                             in_or: bool=False) -> list:
     """
     Convert a list of triggers into a list of strings.
     :param source_in: The list of triggers from the JSON.
     :param fields_in: A dict of substitutable fields.
+    :param registry: The templates to expand.
     :param in_or: If True, then processing statements from an OR
     :return: a list of strings.
     """
@@ -88,18 +92,19 @@ def convert_triggers_to_text(source_in: list, fields_in: dict, in_or: bool=False
     while deque:
         item = deque.popleft()
         if isinstance(item, list):
-            logging.debug("T2T: LIST {}".format(pformat(item)))
+            logging.debug("T2T: LIST %s", LazyFormat(item))
             logging.debug("Converting OR block to text")
             assert not in_or, "Nested OR block found"
             # A list within a list is an OR block.
-            or_lines = convert_triggers_to_text(item, fields_in, True)
+            or_lines = convert_triggers_to_text(item, fields_in, registry,
+                                                True)
             or_statement = "OR({})".format(len(or_lines))
             while or_lines:
                 deque.appendleft(or_lines.pop())
             deque.appendleft(or_statement)
 
         elif isinstance(item, dict):
-            logging.debug("T2T: DICT {}".format(pformat(item)))
+            logging.debug("T2T: DICT %s", LazyFormat(item))
             assert 1 == len(item), "Detected dict with multiple trigger keys"
             key, value = item.popitem()
             if value:
@@ -107,12 +112,12 @@ def convert_triggers_to_text(source_in: list, fields_in: dict, in_or: bool=False
             else:
                 value = fields_in
 
-            data = Substituter(key).expand(value)
+            data = registry.substituter(key).expand(value)
             while data:
                 deque.appendleft(data.pop())
 
         elif isinstance(item, str):
-            logging.debug("T2T: STR {}".format(pformat(item)))
+            logging.debug("T2T: STR %s", LazyFormat(item))
             for key, value in fields_in.items():
                 search_term = "<{}>".format(key)
                 # logging.debug("Replacing '{}' with '{}' in '{}'".format(
@@ -121,7 +126,7 @@ def convert_triggers_to_text(source_in: list, fields_in: dict, in_or: bool=False
             lines += [item]
         else:
             assert False, "Trigger contains unknown type"
-        logging.debug("T2T: END {}".format(pformat(item)))
+        logging.debug("T2T: END %s", LazyFormat(item))
 
     out = list()
     for line in lines:
@@ -130,53 +135,267 @@ def convert_triggers_to_text(source_in: list, fields_in: dict, in_or: bool=False
     return out
 
 
-def convert_json_to_baf(source: dict) ->str:
+def convert_row_to_block(source: dict, fields: dict,
+                         registry: TemplateRegistry) -> str:
     """
-    Return a BAF string that represents the JSON provided.
+    Return the BAF text of one block of a snippet.
+    :param source: The snippet.
+    :param fields: The field values of the block.
+    :param registry: The templates to expand.
+    :return: The text, ending in a blank line.
+    """
+    from copy import deepcopy
+    fields = deepcopy(fields)
+    logging.debug("Handling fields %s", LazyFormat(fields))
+    out = ["IF"] + convert_triggers_to_text(
+        deepcopy(source["IF"]), fields, registry)
+
+    out.append("THEN")
+
+    for item in source["THEN"]:
+        item = deepcopy(item)
+        assert 1 == len(item), "Detected dict with multiple action keys"
+        key, value = item.popitem()
+        weight = int(key)
+        out += convert_actions_to_text(weight, value, fields, registry)
+
+    out.append("END")
+    return '\n'.join(out) + '\n\n'
+
+
+class RenderPlan(object):
+    """
+    A snippet compiled for rendering many field rows.  The snippet is
+    rendered once with a marker in place of each field value, and the
+    text is cut at the markers into static text and field slots.  A row
+    is then rendered by joining the static text with its values.
+
+    Values that could change the text around them fall back to the slow
+    path: anything holding "<" (which a later field could substitute
+    into), "/" (which could start a comment), a newline, or "'" where it
+    is not in a comment (where it would be turned into '"').
+    attributes:
+    * source   : The snippet
+    * registry : The templates to expand
+    * plans    : Dict of field names to (parts, names in code)
+    """
+    __slots__ = ("source", "registry", "plans")
+
+    _unsafe = re.compile(r"[</\n\x00]")
+    _marker = re.compile("\x00(\\d+)\x00")
+
+    def __init__(self, source: dict, registry: TemplateRegistry):
+        self.source = source
+        self.registry = registry
+        self.plans = {}
+
+    def compile(self, names: tuple):
+        """
+        Build the plan for rows with the given field names.
+        :param names: The field names, sorted.
+        :return: (parts, names in code), where parts alternates static
+        text and field names.
+        """
+        markers = {}
+        for i, name in enumerate(names):
+            markers[name] = "\x00{}\x00".format(i)
+        text = convert_row_to_block(self.source, markers, self.registry)
+        # Quotes are replaced up to the last "//" of a line.
+        code = set()
+        for line in text.split("\n"):
+            comment = line.rfind("//")
+            for m in self._marker.finditer(line):
+                if comment < 0 or m.start() < comment:
+                    code.add(names[int(m.group(1))])
+        parts = self._marker.split(text)
+        for i in range(1, len(parts), 2):
+            parts[i] = names[int(parts[i])]
+        return parts, code
+
+    def plan(self, names: tuple):
+        """
+        :param names: The field names, sorted.
+        :return: The plan for rows with those names, see compile.
+        """
+        try:
+            return self.plans[names]
+        except KeyError:
+            pass
+        result = self.plans[names] = self.compile(names)
+        return result
+
+    def unsafe(self, name: str, value: str, code: set) -> bool:
+        """
+        :return: True if the value of a field can't go through the plan.
+        """
+        return bool(self._unsafe.search(value)) or \
+            ("'" in value and name in code)
+
+    def render(self, fields: dict):
+        """
+        Render one row.
+        :param fields: The field values of the row.
+        :return: The text of the block, or None if the row has to go
+        through the slow path.
+        """
+        parts, code = self.plan(tuple(sorted(fields)))
+        for name, value in fields.items():
+            if self.unsafe(name, value, code):
+                return None
+        out = parts[:]
+        for i in range(1, len(out), 2):
+            out[i] = fields[out[i]]
+        return "".join(out)
+
+    def render_rows(self, shared: dict, keys: list, rows: list) -> list:
+        """
+        Render the rows of a compact snippet.  The shared values are
+        joined into the static text once, so each row only fills in its
+        own values.
+        :param shared: The field values common to every row.
+        :param keys: The names of the fields that vary.
+        :param rows: For each row, the values of keys.
+        :return: For each row, the text of the block, or None if the row
+        has to go through the slow path.
+        """
+        parts, code = self.plan(tuple(sorted(set(shared) | set(keys))))
+        for name, value in shared.items():
+            if name not in keys and self.unsafe(name, value, code):
+                return [None] * len(rows)
+        index = {key: i for i, key in enumerate(keys)}
+        static = [parts[0]]
+        slots = []
+        for i in range(1, len(parts), 2):
+            if parts[i] in index:
+                slots.append(index[parts[i]])
+                static.append(parts[i + 1])
+            else:
+                static[-1] += shared[parts[i]] + parts[i + 1]
+
+        result = []
+        out = [None] * (2 * len(slots) + 1)
+        out[0::2] = static
+        for values in rows:
+            if any(self.unsafe(key, value, code)
+                   for key, value in zip(keys, values)):
+                result.append(None)
+                continue
+            out[1::2] = [values[i] for i in slots]
+            result.append("".join(out))
+        return result
+
+
+def snippet_rows(source: dict) -> list:
+    """
+    Return the field rows of a snippet, in either form: a "fields" list
+    of dicts, or "shared" values plus a "rows" table of the values that
+    vary ({"keys": [names], "values": [[row values], ...]}).
+    :param source: The snippet.
+    :return: A list of dicts of field values.
+    """
+    if "rows" not in source:
+        return source["fields"]
+    shared = source.get("shared", {})
+    keys = source["rows"]["keys"]
+    result = []
+    for values in source["rows"]["values"]:
+        fields = dict(shared)
+        fields.update(zip(keys, values))
+        result.append(fields)
+    return result
+
+
+def row_count(source: dict) -> int:
+    """
+    :return: The number of blocks in a snippet, in either form.
     """
-    if 1 < len(source["fields"]):
+    if "rows" in source:
+        return len(source["rows"]["values"])
+    return len(source["fields"])
+
+
+def convert_json_to_blocks(source: dict, registry: TemplateRegistry) -> list:
+    """
+    Return the BAF text of each block (one per fields row) of the JSON
+    provided.
+    :param source: The snippet.
+    :param registry: The templates to expand.
+    :return: A list of strings, each ending in a blank line.
+    """
+    count = row_count(source)
+    if 1 < count:
         if "name" in source:
             logging.info ("Combining multi-part {} ({})".format(
-                source["name"], len(source["fields"])
+                source["name"], count
             ))
         else:
             logging.info ("Combining multi-part <unnamed> ({})".format(
-                len(source["fields"])
+                count
             ))
+        plan = RenderPlan(source, registry)
     else:
         if "name" in source:
             logging.info ("Combining single-part {} ({})".format(
-                source["name"], len(source["fields"])
+                source["name"], count
             ))
         else:
             logging.info ("Combining single-part <unnamed> ({})".format(
-                len(source["fields"])
+                count
             ))
-
-    result = ""
-
+        plan = None
+
+    if "rows" in source:
+        shared = source.get("shared", {})
+        keys = source["rows"]["keys"]
+        values = source["rows"]["values"]
+        if plan:
+            texts = plan.render_rows(shared, keys, values)
+        else:
+            texts = [None] * count
+        result = []
+        for text, row in zip(texts, values):
+            if text is None:
+                fields = dict(shared)
+                fields.update(zip(keys, row))
+                text = convert_row_to_block(source, fields, registry)
+            result.append(text)
+        return result
+
+    result = []
     for fields in source["fields"]:
-        fields = deepcopy(fields)
-        logging.debug("Handling fields {}".format(pformat(fields)))
-        out = ["IF"] + convert_triggers_to_text(
-            deepcopy(source["IF"]), fields)
+        text = plan.render(fields) if plan else None
+        if text is None:
+            text = convert_row_to_block(source, fields, registry)
+        result.append(text)
+    return result
 
-        out.append("THEN")
 
-        for item in source["THEN"]:
-            item = deepcopy(item)
-            assert 1 == len(item), "Detected dict with multiple action keys"
-            key, value = item.popitem()
-            weight = int(key)
-            out = out + convert_actions_to_text(weight, value, fields)
+def convert_json_to_baf(source: dict, registry: TemplateRegistry) -> str:
+    """
+    Return a BAF string that represents the JSON provided.
+    :param source: The snippet.
+    :param registry: The templates to expand.
+    """
+    return "".join(convert_json_to_blocks(source, registry))
 
-        out.append("END")
-        result = result + '\n'.join(out) + '\n\n'
-    return result
 
+def render(snippets: list, registry: TemplateRegistry) -> str:
+    """
+    Return the BAF text for a list of snippets.
+    :param snippets: The snippets, in script order.
+    :param registry: The templates to expand.
+    :return: The script text.
+    """
+    return "".join(convert_json_to_baf(source, registry)
+                   for source in snippets)
 
-def combine_file(source_dir: str, target_file: str):
-    """Take snippets and put them back together"""
+
+def list_dir_snippets(source_dir: str) -> list:
+    """
+    Return the snippet files of a directory, in script order.
+    :param source_dir: The directory holding the snippets.
+    :return: A sorted list of paths.
+    """
     logging.info("Sorting directory '{}'".format(source_dir))
     files = []
     for file in os.listdir(source_dir):
@@ -184,21 +403,72 @@ def combine_file(source_dir: str, target_file: str):
         logging.debug("Examining '{}'".format(file))
         if os.path.isfile(file) and file.endswith(".json"):
             files.append(file)
+    files.sort()
+    return files
+
+
+def resolve_entries(project_dir: str, entries: list) -> list:
+    """
+    Turn the manifest entries of a target into snippet paths.
+    :param project_dir: The directory the entries are relative to.
+    :param entries: The entries from the manifest.
+    :return: A list of paths, in script order.
+    """
+    result = []
+    for entry in entries:
+        path = os.path.join(project_dir, entry)
+        if os.path.isdir(path):
+            result += list_dir_snippets(path)
+        else:
+            result.append(path + ".json")
+    return result
 
+
+def list_snippets(source_dir: str) -> list:
+    """
+    Return the snippet files of a script, in script order.  If the
+    project has a manifest (see manifest.py) listing the script, these
+    are its entries, which may be shared snippets in the library;
+    otherwise they are the files in the script's directory.
+    :param source_dir: The directory named after the script.
+    :return: A list of paths.
+    """
+    project_dir, name = os.path.split(os.path.normpath(source_dir))
+    try:
+        with open(os.path.join(project_dir, manifest_name)) as fp:
+            entries = json.load(fp)["targets"][name]
+    except (OSError, ValueError, KeyError):
+        return list_dir_snippets(source_dir)
+    return resolve_entries(project_dir, entries)
+
+
+def load_snippets(source_dir: str) -> list:
+    """
+    Load the snippets of a directory, in script order.
+    :param source_dir: The directory holding the snippets.
+    :return: A list of snippet dicts.
+    """
+    result = []
+    for file in list_snippets(source_dir):
+        with open(file) as fin:
+            result.append(json.load(fin))
+    return result
+
+
+def combine_file(source_dir: str, target_file: str,
+                 registry: TemplateRegistry):
+    """Take snippets and put them back together"""
+    files = list_snippets(source_dir)
     if 0 == len(files):
         logging.warning("No files found for combine")
         return
 
-    files.sort()
-
     logging.debug("Writing file '{}'".format(target_file))
     with open(target_file, "w") as fout:
         for file in files:
             with open(file) as fin:
                 logging.info("Processing file '{}'".format(file))
-                # fout.write("// {}\n".format(file))
-                # data = fin.read()
-                data = convert_json_to_baf(json.load(fin))
+                data = convert_json_to_baf(json.load(fin), registry)
                 fout.write(data)
 
 
@@ -208,8 +478,30 @@ if __name__ == "__main__":
     parser.add_argument('--auto_delete', action='store_true', default=True)
     parser.add_argument('-v', '--verbose', action='count', default=0)
     parser.add_argument('-d', '--search_dir', default=search_dir)
+    parser.add_argument('-t', '--templates',
+                        help="Directory holding if/then (default: search_dir)")
+    parser.add_argument('--no_cache', action='store_true',
+                        help="Don't use the compiled template cache")
+    parser.add_argument('--reorder', action='store_true',
+                        help="Reorder blocks that commute, cheapest first")
+    parser.add_argument('--costs',
+                        help="Trigger cost table for --reorder and --variants")
+    parser.add_argument('--profile',
+                        help="JSON of block key to times fired, for --reorder")
+    parser.add_argument('--throttle', action='store_true',
+                        help="Put target searches behind scan timers")
+    parser.add_argument('--intervals',
+                        help="Scan interval table for --throttle")
+    parser.add_argument('--variants', action='store_true',
+                        help="Also write class variants of each script to "
+                             "search_dir/variants")
+    parser.add_argument('--spells', help="Spell table for --variants")
+    parser.add_argument('names', nargs='*',
+                        help="Scripts to combine, such as X_PICK (default: all)")
 
     args = parser.parse_args()
+    if args.reorder and args.throttle:
+        parser.error("--reorder and --throttle can't be used together")
     if args.verbose == 0:
         level = logging.WARNING
     elif args.verbose == 1:
@@ -218,16 +510,69 @@ if __name__ == "__main__":
         level = logging.DEBUG
     logging.basicConfig(stream=sys.stdout, level=level)
     logging.info("Verbosity = {}".format(logging.getLevelName(level)))
-    logging.info("SearchDir = '{}'".format(search_dir))
+    logging.info("SearchDir = '{}'".format(args.search_dir))
 
+    names = set(name.lower() for name in args.names)
     targets = []
     for file_name in os.listdir(args.search_dir):
-        if file_name.lower().endswith('.baf'):
-            file_path = os.path.realpath(os.path.join(args.search_dir, file_name))
-            targets.append(file_path)
+        prefix, suffix = os.path.splitext(file_name)
+        if suffix.lower() != '.baf':
+            continue
+        if names and prefix.lower() not in names and \
+                file_name.lower() not in names:
+            continue
+        file_path = os.path.realpath(os.path.join(args.search_dir, file_name))
+        targets.append(file_path)
+
+    registry = TemplateRegistry.load(args.templates or args.search_dir,
+                                     not args.no_cache)
+    if args.reorder:
+        import commute
+        costs = commute.load_costs(args.costs or commute.default_costs_path)
+        profile = None
+        if args.profile:
+            with open(args.profile) as fp:
+                profile = json.load(fp)
+    if args.throttle:
+        import throttle
+        intervals = throttle.load_intervals(
+            args.intervals or throttle.default_intervals_path)
+    if args.variants:
+        import commute
+        import variants
+        table = variants.SpellTable(
+            args.spells or variants.default_classes_path)
+        variant_costs = commute.load_costs(
+            args.costs or commute.default_costs_path)
 
     for target in targets:
         source = os.path.splitext(target)[0]
         logging.info("Source = '{}'".format(source))
         logging.info("Target = '{}'".format(target))
-        combine_file(source, target)
+        if args.variants:
+            results = variants.write_variants(source, registry, table,
+                                              variant_costs)
+            for name, (kept, removed, triggers, cost) in results.items():
+                logging.warning(
+                    "{}_{}: removed {} of {} blocks, saving {} trigger "
+                    "evaluations (cost {:.0f}) per idle tick".format(
+                        os.path.basename(source), name, len(removed),
+                        kept + len(removed), triggers, cost))
+                for key in removed:
+                    logging.info("    removed {}".format(key))
+        if args.throttle:
+            count = throttle.throttle_file(source, target, registry, intervals)
+            logging.warning("{}: throttled {} snippets".format(
+                os.path.basename(target), count))
+            continue
+        if not args.reorder:
+            combine_file(source, target, registry)
+            continue
+        blocks = commute.load_blocks(source, registry)
+        ordered = commute.reorder(blocks, costs, profile)
+        moved = sum(1 for a, b in zip(blocks, ordered) if a is not b)
+        logging.warning("{}: reordered {} of {} blocks".format(
+            os.path.basename(target), moved, len(blocks)))
+        with open(target, "w") as fout:
+            for block in ordered:
+                fout.write(block.text)
@@ -0,0 +1,388 @@
+#! /usr/bin/env python3
+import argparse
+import heapq
+import json
+import logging
+import os
+import re
+import sys
+
+from combine import convert_json_to_blocks, list_snippets
+from globals import tools_dir, project_name
+from registry import TemplateRegistry
+from split import parse_if_then
+
+# Default relative cost of evaluating each trigger.
+default_costs_path = os.path.join(tools_dir, "trigger_costs.json")
+
+_trigger_regex = re.compile(r"^(?P<neg>!?)(?P<name>\w+)\((?P<args>.*)\)$")
+
+# Triggers that change which object "LastSeenBy" refers to.
+_context_setters = {"See"}
+
+# Object references that depend on triggers evaluated earlier.
+_context_regex = re.compile(r"\bLast\w*\(")
+
+# Global-style triggers, mapped to the comparison they make.
+_global_tests = {
+    "GLOBAL": "eq",
+    "GLOBALLT": "lt",
+    "GLOBALGT": "gt",
+}
+
+
+def split_args(args: str) -> list:
+    """
+    Split trigger arguments on the commas that are not nested in
+    parentheses or brackets.
+    :param args: The text between the trigger's outer parentheses.
+    :return: A list of stripped arguments.
+    """
+    result = []
+    depth = 0
+    start = 0
+    for i, char in enumerate(args):
+        if char in "([":
+            depth += 1
+        elif char in ")]":
+            depth -= 1
+        elif "," == char and 0 == depth:
+            result.append(args[start:i].strip())
+            start = i + 1
+    result.append(args[start:].strip())
+    return result
+
+
+def parse_trigger(line: str):
+    """
+    Break a trigger line into its parts.
+    :param line: The trigger, without any comment.
+    :return: (negated, name, [args]) or None if the line isn't a trigger.
+    """
+    m = _trigger_regex.match(line.split("//")[0].strip())
+    if not m:
+        return None
+    return "!" == m.group("neg"), m.group("name"), split_args(m.group("args"))
+
+
+class Range(object):
+    """
+    The integer values a global may hold, from the tests made on it.
+    """
+    __slots__ = ("low", "high", "excluded")
+
+    def __init__(self):
+        self.low = None
+        self.high = None
+        self.excluded = set()
+
+    def add(self, test: str, negated: bool, value: int):
+        """
+        Narrow the range by one test.
+        :param test: "eq", "lt" or "gt".
+        :param negated: True if the trigger was negated.
+        :param value: The value tested against.
+        """
+        if "eq" == test and negated:
+            self.excluded.add(value)
+            return
+        if "eq" == test:
+            low, high = value, value
+        elif ("lt" == test) != negated:
+            # x < value, or !(x > value) == x <= value
+            low, high = None, value - 1 if "lt" == test else value
+        else:
+            # x > value, or !(x < value) == x >= value
+            low, high = value + 1 if "gt" == test else value, None
+        if low is not None and (self.low is None or low > self.low):
+            self.low = low
+        if high is not None and (self.high is None or high < self.high):
+            self.high = high
+
+    def empty(self) -> bool:
+        """
+        :return: True if no value satisfies every test.
+        """
+        if self.low is not None and self.high is not None:
+            if self.low > self.high:
+                return True
+            if self.high - self.low < len(self.excluded):
+                return all(value in self.excluded
+                           for value in range(self.low, self.high + 1))
+        return False
+
+    def merged(self, other: "Range") -> "Range":
+        """
+        :return: A Range holding the tests of both ranges.
+        """
+        result = Range()
+        result.low = self.low
+        result.high = self.high
+        result.excluded = self.excluded | other.excluded
+        if other.low is not None and (result.low is None or
+                                      other.low > result.low):
+            result.low = other.low
+        if other.high is not None and (result.high is None or
+                                       other.high < result.high):
+            result.high = other.high
+        return result
+
+
+class Block(object):
+    """
+    One rendered IF/THEN block, with what the analysis needs to know
+    about its triggers.
+    attributes:
+    * key      : "<snippet>:<row>", used to look up profile data
+    * text     : The BAF text of the block
+    * triggers : The top-level (AND-ed) trigger lines
+    * literals : Set of (negated, trigger) for the top-level triggers
+    * globals  : Dict of (variable, scope) to Range
+    * sees     : True if the block changes what LastSeenBy refers to
+    * reads    : True if the block uses LastSeenBy (or another Last*
+                 reference) before setting it itself
+    """
+    __slots__ = ("key", "text", "triggers", "literals", "globals", "sees",
+                 "reads")
+
+    def __init__(self, key: str, text: str):
+        self.key = key
+        self.text = text
+        conditions = parse_if_then(text, key)["IF"]
+        self.triggers = [item for item in conditions if isinstance(item, str)]
+        self.sees = False
+        self.reads = False
+        for item in conditions:
+            for line in item if isinstance(item, list) else [item]:
+                parsed = parse_trigger(line)
+                if parsed and parsed[1] in _context_setters:
+                    self.sees = True
+                elif not self.sees and _context_regex.search(line):
+                    self.reads = True
+
+        self.literals = set()
+        self.globals = {}
+        for line in self.triggers:
+            parsed = parse_trigger(line)
+            if parsed is None:
+                continue
+            negated, name, args = parsed
+            if _context_regex.search(line):
+                # The same text may name a different object in each block.
+                continue
+            self.literals.add((negated, "{}({})".format(name, ",".join(args))))
+            test = _global_tests.get(name.upper())
+            if test is None or 3 != len(args):
+                continue
+            try:
+                value = int(args[2])
+            except ValueError:
+                continue
+            variable = (args[0].strip("'\"").upper(),
+                        args[1].strip("'\"").upper())
+            self.globals.setdefault(variable, Range()).add(
+                test, negated, value)
+
+    def excludes(self, other: "Block") -> bool:
+        """
+        Return True if this block and other can never both be true.
+        :param other: The other block.
+        :return: True if the blocks are mutually exclusive.
+        """
+        for negated, trigger in self.literals:
+            if (not negated, trigger) in other.literals:
+                return True
+        for variable, values in self.globals.items():
+            if variable in other.globals and \
+                    values.merged(other.globals[variable]).empty():
+                return True
+        return False
+
+    def commutes(self, other: "Block") -> bool:
+        """
+        Return True if this block and other may be swapped.  They must
+        exclude each other, and neither may change the LastSeenBy object
+        the other depends on.
+        :param other: The other block.
+        :return: True if the blocks commute.
+        """
+        if (self.sees and other.reads) or (self.reads and other.sees):
+            return False
+        return self.excludes(other)
+
+
+def context_readers(blocks: list) -> list:
+    """
+    See() changes LastSeenBy whether or not its block fires, so blocks
+    that call See() can't be swapped when a block reading LastSeenBy
+    follows them.  A reader before every See() block sees what the last
+    See() of the previous pass left, so then none of them can be.
+    :param blocks: The blocks, in script order.
+    :return: For each block, True if a reader depends on the order of the
+    See() blocks up to and including it.
+    """
+    result = [False] * len(blocks)
+    later = False
+    for i in range(len(blocks) - 1, -1, -1):
+        result[i] = later
+        later = later or blocks[i].reads
+    for block in blocks:
+        if block.sees:
+            break
+        if block.reads:
+            return [True] * len(blocks)
+    return result
+
+
+def keeps_order(first: Block, second: Block, readers: bool) -> bool:
+    """
+    Return True if first must stay before second.
+    :param first: The earlier block.
+    :param second: The later block.
+    :param readers: The context_readers entry of second.
+    :return: True if the blocks may not be swapped.
+    """
+    if readers and first.sees and second.sees:
+        return True
+    return not first.commutes(second)
+
+
+def load_blocks(source_dir: str, registry: TemplateRegistry) -> list:
+    """
+    Render the snippets of a directory into Blocks, in script order.
+    :param source_dir: The directory holding the snippets.
+    :param registry: The templates to expand.
+    :return: A list of Block objects.
+    """
+    result = []
+    for file in list_snippets(source_dir):
+        with open(file) as fp:
+            snippet = json.load(fp)
+        name = os.path.splitext(os.path.basename(file))[0]
+        for row, text in enumerate(convert_json_to_blocks(snippet, registry)):
+            result.append(Block("{}:{}".format(name, row), text))
+    return result
+
+
+def freedom_classes(blocks: list) -> list:
+    """
+    Group a script into runs of adjacent blocks that all exclude one
+    another.  Blocks within a run may be put in any order.
+    :param blocks: The blocks, in script order.
+    :return: A list of lists of blocks.
+    """
+    readers = context_readers(blocks)
+    result = []
+    for block, later in zip(blocks, readers):
+        if result and all(not keeps_order(item, block, later)
+                          for item in result[-1]):
+            result[-1].append(block)
+        else:
+            result.append([block])
+    return result
+
+
+def block_cost(block: Block, costs: dict) -> float:
+    """
+    Estimate the cost of evaluating a block that does not fire.  Each
+    trigger is assumed to pass half the time, so later triggers count
+    for less.
+    :param block: The block.
+    :param costs: Dict of trigger name to relative cost, with "default".
+    :return: The estimated cost.
+    """
+    result = 0.0
+    weight = 1.0
+    for line in block.triggers:
+        parsed = parse_trigger(line)
+        name = parsed[1] if parsed else None
+        result += weight * costs.get(name, costs["default"])
+        weight /= 2
+    return result
+
+
+def reorder(blocks: list, costs: dict, profile: dict = None) -> list:
+    """
+    Reorder a script without changing which block fires.  A block is only
+    ever moved past blocks it may be swapped with (see keeps_order), so
+    the result is a topological order of the "must stay before" relation.
+    Among the blocks free to go next, the one with the lowest cost /
+    chance of firing goes first.
+    :param blocks: The blocks, in script order.
+    :param costs: Dict of trigger name to relative cost, with "default".
+    :param profile: Dict of block key to times fired, or None.
+    :return: The reordered list of blocks.
+    """
+    count = len(blocks)
+    readers = context_readers(blocks)
+    successors = [[] for _ in range(count)]
+    waiting = [0] * count
+    for j in range(count):
+        for i in range(j):
+            if keeps_order(blocks[i], blocks[j], readers[j]):
+                successors[i].append(j)
+                waiting[j] += 1
+
+    priority = []
+    for block in blocks:
+        cost = block_cost(block, costs)
+        if profile:
+            # Never-seen blocks get half a hit so they still sort.
+            cost = cost / profile.get(block.key, 0.5)
+        priority.append(cost)
+
+    ready = [(priority[i], i) for i in range(count) if 0 == waiting[i]]
+    heapq.heapify(ready)
+    result = []
+    while ready:
+        _, i = heapq.heappop(ready)
+        result.append(blocks[i])
+        for j in successors[i]:
+            waiting[j] -= 1
+            if 0 == waiting[j]:
+                heapq.heappush(ready, (priority[j], j))
+    assert len(result) == count, "Block order has a cycle"
+    return result
+
+
+def load_costs(path: str) -> dict:
+    """
+    Load a trigger cost table.
+    :param path: Path to the JSON table.
+    :return: Dict of trigger name to relative cost, with "default".
+    """
+    with open(path) as fp:
+        costs = json.load(fp)
+    costs.setdefault("default", 1)
+    return costs
+
+
+if __name__ == "__main__":
+    search_dir = os.path.join(tools_dir, "..", project_name)
+    parser = argparse.ArgumentParser(
+        description="Report the blocks of a script that can be reordered")
+    parser.add_argument('-v', '--verbose', action='count', default=0)
+    parser.add_argument('-d', '--search_dir', default=search_dir)
+    parser.add_argument('-t', '--templates',
+                        help="Directory holding if/then (default: search_dir)")
+    parser.add_argument('names', nargs='+', help="Scripts, such as X_ALL")
+
+    args = parser.parse_args()
+    if args.verbose == 0:
+        level = logging.WARNING
+    elif args.verbose == 1:
+        level = logging.INFO
+    else:
+        level = logging.DEBUG
+    logging.basicConfig(stream=sys.stdout, level=level)
+
+    registry = TemplateRegistry.load(args.templates or args.search_dir)
+    for name in args.names:
+        blocks = load_blocks(os.path.join(args.search_dir, name), registry)
+        classes = freedom_classes(blocks)
+        free = [item for item in classes if len(item) > 1]
+        print("{}: {} blocks, {} freedom classes of 2+ blocks "
+              "({} blocks)".format(name, len(blocks), len(free),
+                                   sum(len(item) for item in free)))
+        for item in free:
+            print("    " + ", ".join(block.key for block in item))
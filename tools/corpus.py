@@ -0,0 +1,110 @@
+#! /usr/bin/env python3
+import argparse
+import json
+import logging
+import os
+import sys
+
+from globals import tools_dir, project_name
+from registry import TemplateRegistry
+from split import block_templates, iter_collapse, iter_statements, \
+    parse_if_then
+
+
+def find_scripts(roots: list) -> list:
+    """
+    Find every BAF script below a set of directories.
+    :param roots: The directories to search (such as installed mods).  A
+    script named directly is taken as it is.
+    :return: A sorted list of script paths.
+    """
+    result = []
+    for root in roots:
+        if os.path.isfile(root):
+            result.append(root)
+            continue
+        for dir_path, dir_names, file_names in os.walk(root):
+            dir_names.sort()
+            for file_name in file_names:
+                if file_name.lower().endswith('.baf'):
+                    result.append(os.path.join(dir_path, file_name))
+    result.sort()
+    return result
+
+
+def iter_parsed(script: str):
+    """
+    Stream the parsed statements of a script, skipping (with a warning)
+    any statement that cannot be parsed.
+    :param script: Path to the script.
+    :return: A generator of statement dicts.
+    """
+    with open(script, errors="replace") as fp:
+        for count, statement in enumerate(iter_statements(fp), 1):
+            try:
+                yield parse_if_then(statement, script)
+            except AssertionError:
+                logging.warning("{}: skipping unparseable block {}".format(
+                    script, count))
+
+
+def index_corpus(roots: list, output, registry: TemplateRegistry) -> dict:
+    """
+    Split and index every script below a set of directories.  Statements
+    are streamed through the templates, so only one snippet is held at
+    a time.
+    :param roots: The directories to search.
+    :param output: A file to stream the blocks to as JSON lines, or None.
+    :param registry: The templates to collapse.
+    :return: The index: block counts per script and uses per template.
+    """
+    index = {"scripts": {}, "templates": {}}
+    for script in find_scripts(roots):
+        logging.info("Indexing '{}'".format(script))
+        blocks = 0
+        for data in iter_collapse(iter_parsed(script), registry):
+            blocks += 1
+            data["script"] = script
+            for name in block_templates(data):
+                index["templates"][name] = \
+                    index["templates"].get(name, 0) + len(data["fields"])
+            if output:
+                output.write(json.dumps(data, sort_keys=True))
+                output.write('\n')
+        index["scripts"][script] = blocks
+    return index
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Split and index every AI script below directories")
+    parser.add_argument('roots', nargs='+')
+    parser.add_argument('-o', '--output',
+                        help="Write collapsed blocks here as JSON lines")
+    parser.add_argument('-i', '--index', help="Write the index here")
+    parser.add_argument('-t', '--templates',
+                        default=os.path.join(tools_dir, "..", project_name),
+                        help="Directory holding if/then")
+    parser.add_argument('-v', '--verbose', action='count', default=0)
+
+    args = parser.parse_args()
+    if args.verbose == 0:
+        level = logging.WARNING
+    elif args.verbose == 1:
+        level = logging.INFO
+    else:
+        level = logging.DEBUG
+    logging.basicConfig(stream=sys.stdout, level=level)
+
+    registry = TemplateRegistry(args.templates)
+    if args.output:
+        with open(args.output, "w") as fp:
+            index = index_corpus(args.roots, fp, registry)
+    else:
+        index = index_corpus(args.roots, None, registry)
+
+    if args.index:
+        with open(args.index, "w") as fp:
+            json.dump(index, fp, indent=4, sort_keys=True)
+    print("{} scripts, {} blocks".format(
+        len(index["scripts"]), sum(index["scripts"].values())))
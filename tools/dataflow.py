@@ -0,0 +1,425 @@
+#! /usr/bin/env python3
+"""
+Follow the globals and timers of a project's scripts: which blocks set
+each one and which blocks test it.  From that graph, report
+
+* variables tested but never set by any script (they start at 0, or
+  expired, unless something outside the scripts sets them),
+* blocks that can never fire, because a top-level test asks for a value
+  the variable is never given.  Globals the player sets in the GUI, such
+  as BDAI_SKILL_MODE, take values no script gives them and are skipped;
+  --external names others,
+* coarse gates: runs of adjacent blocks that all test the same guard,
+  such as Global("BDAI_NO_ARCANE","LOCALS",0).  Checking the guard once
+  for the run saves the evaluations each block spends reaching it.
+  With --spread, a gate covers every block of a script that tests the
+  guard, which is what checking it once per tick could save at most.
+
+Every script of a project runs on the same creature, so LOCALS are
+shared between scripts as well as between blocks.  A timer is a global
+holding the time it expires, so a variable is known by its name and
+scope alone: SetGlobal("BD_Cast","LOCALS",0) resets the timer BD_Cast.
+"""
+import argparse
+import logging
+import os
+import sys
+
+from combine import list_snippets
+from commute import Block, default_costs_path, load_blocks, load_costs, \
+    parse_trigger
+from globals import tools_dir, project_name
+from registry import TemplateRegistry
+from split import parse_if_then
+
+# Triggers that read a variable, by the kind of variable.
+_reads = {
+    "GLOBAL": "global",
+    "GLOBALLT": "global",
+    "GLOBALGT": "global",
+    "GLOBALTIMEREXPIRED": "timer",
+    "GLOBALTIMERNOTEXPIRED": "timer",
+}
+
+# Actions that write a variable, by the kind of variable.
+_writes = {
+    "SETGLOBAL": "global",
+    "INCREMENTGLOBAL": "global",
+    "SETGLOBALTIMER": "timer",
+}
+
+# Globals the player sets in the GUI, whatever the scripts set them to.
+default_external = ("BDAI_SKILL_MODE", "BDAI_ATTACK_MODE")
+
+
+def variable_key(args: list) -> tuple:
+    """
+    :return: (name, scope) for the arguments of a trigger or action.
+    """
+    return (args[0].strip("'\" ").upper(),
+            args[1].strip("'\" ").upper() if len(args) > 1 else "")
+
+
+def display(line: str) -> str:
+    """
+    :return: A trigger as it is written in the scripts.
+    """
+    return line.split("//")[0].strip().replace("'", '"')
+
+
+class Variable(object):
+    """
+    One global or timer, with the blocks that read and write it.
+    attributes:
+    * key     : (name, scope)
+    * kinds   : The set of kinds it is read and written as, "global" or
+                "timer"
+    * readers : List of (block key, trigger)
+    * writers : List of (block key, value), value being an int or None
+                for one not known before the script runs, such as the
+                time a timer expires
+    """
+    __slots__ = ("key", "kinds", "readers", "writers")
+
+    def __init__(self, key: tuple):
+        self.key = key
+        self.kinds = set()
+        self.readers = []
+        self.writers = []
+
+    def kind(self) -> str:
+        """
+        :return: "timer" if it is ever used as a timer, else "global".
+        """
+        return "timer" if "timer" in self.kinds else "global"
+
+    def values(self):
+        """
+        :return: The set of values a global may hold, or None if that
+        can't be known.  Globals start at 0.
+        """
+        result = {0}
+        for _, value in self.writers:
+            if value is None:
+                return None
+            result.add(value)
+        return result
+
+    def __str__(self):
+        name, scope = self.key
+        return "{} {}.{}".format(self.kind(), scope, name)
+
+
+def block_accesses(block: Block):
+    """
+    Find the variables a block reads and writes.
+    :param block: The block.
+    :return: (reads, writes): lists of (variable key, kind, trigger) and
+    of (variable key, kind, value set, or None).
+    """
+    parsed = parse_if_then(block.text, block.key)
+    reads = []
+    for item in parsed["IF"]:
+        for line in item if isinstance(item, list) else [item]:
+            trigger = parse_trigger(line)
+            if trigger and trigger[1].upper() in _reads:
+                reads.append((variable_key(trigger[2]),
+                              _reads[trigger[1].upper()], display(line)))
+    writes = []
+    for response in parsed["THEN"]:
+        for actions in response.values():
+            for line in actions:
+                action = parse_trigger(line)
+                if action is None or action[1].upper() not in _writes:
+                    continue
+                name = action[1].upper()
+                value = None
+                if "SETGLOBAL" == name and 3 == len(action[2]):
+                    try:
+                        value = int(action[2][2])
+                    except ValueError:
+                        pass
+                writes.append((variable_key(action[2]), _writes[name],
+                               value))
+    return reads, writes
+
+
+def build_graph(scripts: dict) -> dict:
+    """
+    Build the read/write graph of the globals and timers of some scripts.
+    :param scripts: Dict of script name to its Blocks, in script order.
+    :return: Dict of variable key to Variable.
+    """
+    result = {}
+    for name, blocks in scripts.items():
+        for block in blocks:
+            key = "{}/{}".format(name, block.key)
+            reads, writes = block_accesses(block)
+            for variable, kind, trigger in reads:
+                item = result.setdefault(variable, Variable(variable))
+                item.kinds.add(kind)
+                item.readers.append((key, trigger))
+            for variable, kind, value in writes:
+                item = result.setdefault(variable, Variable(variable))
+                item.kinds.add(kind)
+                item.writers.append((key, value))
+    return result
+
+
+def never_set(graph: dict) -> list:
+    """
+    :return: The Variables that are read but never written, sorted.
+    """
+    return sorted((item for item in graph.values()
+                   if item.readers and not item.writers),
+                  key=lambda item: item.key)
+
+
+def never_read(graph: dict) -> list:
+    """
+    :return: The Variables that are written but never read, sorted.
+    """
+    return sorted((item for item in graph.values()
+                   if item.writers and not item.readers),
+                  key=lambda item: item.key)
+
+
+def range_allows(values, value: int) -> bool:
+    """
+    :param values: A commute.Range.
+    :param value: A value.
+    :return: True if value passes every test the Range holds.
+    """
+    return (values.low is None or value >= values.low) and \
+        (values.high is None or value <= values.high) and \
+        value not in values.excluded
+
+
+def disabled_blocks(scripts: dict, graph: dict,
+                    external=default_external) -> list:
+    """
+    Find the blocks that can never fire because of their globals and
+    timers.  A global the scripts never set may be set from outside them
+    (a dialog, say), so only variables some block writes are judged;
+    a timer no block starts is never running, however often it is reset
+    with SetGlobal.  Even then, a value may come
+    from outside the scripts, so these are findings to check.
+    :param scripts: Dict of script name to its Blocks.
+    :param graph: The build_graph of the scripts.
+    :param external: Names of globals also set outside the scripts, such
+    as by the GUI.  These are never judged.
+    :return: A sorted list of (block key, reason).
+    """
+    external = {name.upper() for name in external}
+    result = []
+    for name, blocks in scripts.items():
+        for block in blocks:
+            key = "{}/{}".format(name, block.key)
+            for (variable, scope), tests in block.globals.items():
+                if variable in external:
+                    continue
+                item = graph.get((variable, scope))
+                values = item.values() if item and item.writers else None
+                if values is not None and \
+                        not any(range_allows(tests, value)
+                                for value in values):
+                    result.append((key, "these scripts only set {} to {}".format(
+                        item, ", ".join(str(value)
+                                        for value in sorted(values)))))
+            for negated, trigger in block.literals:
+                parsed = parse_trigger(trigger)
+                test = parsed[1].upper()
+                if test not in ("GLOBALTIMEREXPIRED",
+                                "GLOBALTIMERNOTEXPIRED"):
+                    continue
+                running = ("GLOBALTIMERNOTEXPIRED" == test) != negated
+                variable = variable_key(parsed[2])
+                item = graph.get(variable)
+                if running and not (item and any(
+                        value is None for _, value in item.writers)):
+                    result.append((key, "timer {}.{} is never set".format(
+                        variable[1], variable[0])))
+    result.sort()
+    return result
+
+
+class Gate(object):
+    """
+    A guard tested at the top level of each block of a run of adjacent
+    blocks, that could be checked once for the whole run instead.
+    attributes:
+    * script  : The script name
+    * guard   : The trigger, as written
+    * blocks  : The block keys of the run
+    * closed  : Evaluations saved per tick while the guard fails
+    * open    : Evaluations saved per tick while the guard passes
+    * cost    : Relative cost saved per tick while the guard fails
+    """
+    __slots__ = ("script", "guard", "blocks", "closed", "open", "cost")
+
+    def __init__(self, script: str, guard: str):
+        self.script = script
+        self.guard = guard
+        self.blocks = []
+        self.closed = -1
+        self.open = -1
+        self.cost = 0.0
+
+    def add(self, block: Block, position: int, costs: dict):
+        """
+        Add a block to the run.  Every trigger before the guard is assumed
+        to pass, so the savings are an upper bound.
+        :param block: The block.
+        :param position: The index of the guard in block.triggers.
+        :param costs: Dict of trigger name to relative cost, with "default".
+        """
+        self.blocks.append(block.key)
+        # Without the gate, the block evaluates up to and including the
+        # guard; the gate's own evaluation is counted once, below zero.
+        self.closed += position + 1
+        self.open += 1
+        for line in block.triggers[:position + 1]:
+            parsed = parse_trigger(line)
+            self.cost += costs.get(parsed[1] if parsed else None,
+                                   costs["default"])
+
+
+def propose_gates(scripts: dict, costs: dict, minimum: int = 2,
+                  spread: bool = False) -> list:
+    """
+    Find the runs of adjacent blocks that share a top-level test of a
+    global or timer.
+    :param scripts: Dict of script name to its Blocks, in script order.
+    :param costs: Dict of trigger name to relative cost, with "default".
+    :param minimum: The fewest blocks a gate may cover.
+    :param spread: If True, one gate covers every block of a script that
+    tests the guard, adjacent or not.  The blocks between rarely commute
+    with the guarded ones, so such a gate can't be had by reordering.
+    :return: A list of Gates, most evaluations saved first.
+    """
+    result = []
+    for name, blocks in scripts.items():
+        runs = {}
+        for block in blocks:
+            guards = {}
+            for position, line in enumerate(block.triggers):
+                parsed = parse_trigger(line)
+                if parsed and parsed[1].upper() in _reads:
+                    guards.setdefault(display(line), position)
+            for guard in [] if spread else list(runs):
+                if guard not in guards:
+                    result.append(runs.pop(guard))
+            for guard, position in guards.items():
+                runs.setdefault(guard, Gate(name, guard)).add(
+                    block, position, costs)
+        result += runs.values()
+    result = [item for item in result if len(item.blocks) >= minimum]
+    result.sort(key=lambda item: (-item.closed, item.script, item.guard))
+    return result
+
+
+def load_scripts(search_dir: str, registry: TemplateRegistry,
+                 names: list = None) -> dict:
+    """
+    Render the snippets of a project's scripts into Blocks.
+    :param search_dir: The project directory.
+    :param registry: The templates to expand.
+    :param names: The scripts, such as X_ALL (default: every directory of
+    snippets with a script of the same name).
+    :return: Dict of script name to its Blocks, in script order.
+    """
+    if not names:
+        names = []
+        for file_name in sorted(os.listdir(search_dir)):
+            prefix, suffix = os.path.splitext(file_name)
+            path = os.path.join(search_dir, prefix)
+            if suffix.lower() == ".baf" and os.path.isdir(path) and \
+                    list_snippets(path):
+                names.append(prefix)
+    return {name: load_blocks(os.path.join(search_dir, name), registry)
+            for name in names}
+
+
+if __name__ == "__main__":
+    search_dir = os.path.join(tools_dir, "..", project_name)
+    parser = argparse.ArgumentParser(
+        description="Report how scripts read and write globals and timers")
+    parser.add_argument('-v', '--verbose', action='count', default=0)
+    parser.add_argument('-d', '--search_dir', default=search_dir)
+    parser.add_argument('-t', '--templates',
+                        help="Directory holding if/then (default: search_dir)")
+    parser.add_argument('--costs', default=default_costs_path,
+                        help="Trigger cost table (default: {})".format(
+                            os.path.basename(default_costs_path)))
+    parser.add_argument('-m', '--minimum', type=int, default=3,
+                        help="Fewest blocks a proposed gate covers")
+    parser.add_argument('-s', '--spread', action='store_true',
+                        help="Gate every block testing a guard, not only "
+                             "runs of adjacent blocks")
+    parser.add_argument('-g', '--graph', action='store_true',
+                        help="List the readers and writers of each variable")
+    parser.add_argument('-e', '--external', action='append',
+                        help="Global set outside the scripts, never judged "
+                             "by its script values; may be repeated "
+                             "(default: {})".format(
+                                 ", ".join(default_external)))
+    parser.add_argument('names', nargs='*',
+                        help="Scripts, such as X_ALL (default: all)")
+
+    args = parser.parse_args()
+    if args.verbose == 0:
+        level = logging.WARNING
+    elif args.verbose == 1:
+        level = logging.INFO
+    else:
+        level = logging.DEBUG
+    logging.basicConfig(stream=sys.stdout, level=level)
+
+    registry = TemplateRegistry.load(args.templates or args.search_dir)
+    scripts = load_scripts(args.search_dir, registry, args.names)
+    graph = build_graph(scripts)
+    print("{} scripts, {} blocks, {} globals and timers".format(
+        len(scripts), sum(len(blocks) for blocks in scripts.values()),
+        len(graph)))
+
+    if args.graph:
+        print("\nRead/write graph:")
+        for key in sorted(graph):
+            item = graph[key]
+            print("  {}".format(item))
+            for label, users in (("set by", item.writers),
+                                 ("read by", item.readers)):
+                counts = {}
+                for block, _ in users:
+                    script = block.split("/")[0]
+                    counts[script] = counts.get(script, 0) + 1
+                if counts:
+                    print("    {} {}".format(label, ", ".join(
+                        "{} ({})".format(script, count)
+                        for script, count in sorted(counts.items()))))
+
+    print("\nNever set by these scripts:")
+    for item in never_set(graph):
+        print("  {} (read by {} blocks)".format(item, len(item.readers)))
+    print("\nSet but never read:")
+    for item in never_read(graph):
+        print("  {} (set by {} blocks)".format(item, len(item.writers)))
+    external = {name.upper() for name in args.external or default_external}
+    print("\nAlso set outside the scripts, so never judged:")
+    for key in sorted(graph):
+        if "global" == graph[key].kind() and key[0] in external:
+            print("  {} (read by {} blocks)".format(
+                graph[key], len(graph[key].readers)))
+    print("\nBlocks that can never fire:")
+    for key, reason in disabled_blocks(scripts, graph, external):
+        print("  {}: {}".format(key, reason))
+
+    print("\nProposed gates (evaluations saved per tick, at most):")
+    print("  {:<10} {:>6} {:>8} {:>6} {:>8}  guard".format(
+        "script", "blocks", "closed", "open", "cost"))
+    for gate in propose_gates(scripts, load_costs(args.costs), args.minimum,
+                              args.spread):
+        print("  {:<10} {:>6} {:>8} {:>6} {:>8.0f}  {}".format(
+            gate.script, len(gate.blocks), gate.closed, gate.open, gate.cost,
+            gate.guard))
+        logging.info("    {} .. {}".format(gate.blocks[0], gate.blocks[-1]))
@@ -9,3 +9,19 @@ tools_dir = os.path.dirname(os.path.realpath(__file__))
 # The script project name, which will be the name of the directory
 # off of the base (not in source control).
 project_name = "xseries"
+
+
+class LazyFormat(object):
+    """
+    A stand-in for pprint.pformat in log calls.  pprint is imported and
+    the value formatted only if the record is actually emitted, so pass
+    it as a logging argument: logging.debug("x = %s", LazyFormat(x))
+    """
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        import pprint
+        return pprint.pformat(self.value)
@@ -0,0 +1,97 @@
+#! /usr/bin/env python3
+"""
+Find the terms snipindex.py indexes in a snippet file.  Kept apart from
+snipindex.py so that queries against an up-to-date index don't have to
+import the renderer.
+"""
+import json
+
+from combine import convert_json_to_blocks
+from commute import parse_trigger
+from registry import TemplateRegistry
+from split import block_templates
+from substituter import ElementOR, ElementTemplate
+
+# Triggers and actions, by the term their arguments name.
+_spell_names = {"HAVESPELL", "HAVESPELLRES", "SPELL", "SPELLRES",
+                "SPELLNODEC", "SPELLNODECRES", "FORCESPELL", "FORCESPELLRES",
+                "REALLYFORCESPELL", "REALLYFORCESPELLRES"}
+_global_names = {"GLOBAL", "GLOBALLT", "GLOBALGT", "SETGLOBAL",
+                 "INCREMENTGLOBAL"}
+_timer_names = {"GLOBALTIMEREXPIRED", "GLOBALTIMERNOTEXPIRED",
+                "SETGLOBALTIMER"}
+
+
+def template_names(snippet: dict, registry: TemplateRegistry) -> set:
+    """
+    :return: The names of the templates a snippet uses, nested ones
+    included.
+    """
+    found = set()
+    for name in block_templates(snippet):
+        if name not in found:
+            found.add(name)
+            nested_names(registry.substituter(name).template, found)
+    return found
+
+
+def nested_names(template: ElementTemplate, found: set):
+    """
+    Add the names of the templates nested in a template to found.
+    """
+    for element in template.elements:
+        for item in element.elements if isinstance(element, ElementOR) \
+                else [element]:
+            if isinstance(item, ElementTemplate) and item.name not in found:
+                found.add(item.name)
+                nested_names(item, found)
+
+
+def block_terms(text: str) -> dict:
+    """
+    Find the spells, globals, timers and string IDs a block names.
+    :param text: The BAF text of the block.
+    :return: Dict of kind to sorted list of terms.
+    """
+    terms = {"spell": set(), "global": set(), "timer": set(),
+             "string": set()}
+    for line in text.split("\n"):
+        parsed = parse_trigger(line.strip())
+        if parsed is None:
+            continue
+        _, name, args = parsed
+        name = name.upper()
+        args = [arg.strip("'\" ").upper() for arg in args]
+        if name in _spell_names:
+            # The resource comes first in HaveSpell* and the *RES actions,
+            # such as SpellRES("SPDWD02",Myself); the spell comes last in
+            # Spell(Myself,WIZARD_STONE_SKIN) and the like.
+            if name.startswith("HAVESPELL") or name.endswith("RES"):
+                terms["spell"].add(args[0])
+            else:
+                terms["spell"].add(args[-1])
+        elif name in _global_names or name in _timer_names:
+            terms["global" if name in _global_names else "timer"].add(
+                args[0])
+        elif name.startswith("DISPLAYSTRING") and len(args) > 1 and \
+                args[1].isdigit():
+            terms["string"].add(args[1])
+    return {kind: sorted(value) for kind, value in terms.items()}
+
+
+def index_file(path: str, registry: TemplateRegistry) -> list:
+    """
+    Index the blocks of one snippet file.
+    :param path: The snippet file.
+    :param registry: The templates of its project.
+    :return: A list of [row, name, terms] for its blocks.
+    """
+    with open(path) as fp:
+        snippet = json.load(fp)
+    templates = template_names(snippet, registry)
+    result = []
+    for row, text in enumerate(convert_json_to_blocks(snippet, registry)):
+        terms = block_terms(text)
+        terms["template"] = sorted(name.upper() for name in templates)
+        result.append([row, snippet.get("name"), terms])
+    return result
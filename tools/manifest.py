@@ -0,0 +1,314 @@
+#! /usr/bin/env python3
+"""
+Build several scripts from one manifest.
+
+A manifest lists, for each target script, the snippets it is made of:
+
+    {
+        "library": "library",
+        "targets": {
+            "X_FIGHT": ["library/Attack-Somebody", ...],
+            "X_ALL": ["X_ALL/0010-Reset-Vars-On-Init", ...,
+                      "library/Attack-Somebody"]
+        }
+    }
+
+Each entry is a path relative to the project directory, without ".json".
+An entry naming a directory stands for all of its snippets, in order.
+Snippets with the same content are rendered once per run, however many
+targets use them.
+
+The library directory holds the only copy of each shared snippet.  Once a
+project has a manifest, combine.py (and every tool that lists a script's
+snippets through combine.list_snippets) reads the targets it names from
+the manifest.  split.py writes each script's snippets to its directory
+as before, then relinks the target: a snippet equal to one in the
+library is removed and its entry points at the library again.  A shared
+snippet edited in one script's BAF therefore becomes that script's own
+snippet; the library, and the other scripts, keep the old one.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+from combine import convert_json_to_baf, list_dir_snippets, list_snippets, \
+    manifest_name, resolve_entries, row_count
+from globals import tools_dir, project_name
+from registry import TemplateRegistry
+
+
+def snippet_key(snippet: dict) -> str:
+    """
+    :return: Canonical text of a snippet, equal for equal content.
+    """
+    return json.dumps(snippet, sort_keys=True, separators=(",", ":"))
+
+
+def content_key(snippet: dict) -> str:
+    """
+    :return: Canonical text of what a snippet renders to, equal for
+    snippets that differ only in name.
+    """
+    return snippet_key({key: value for key, value in snippet.items()
+                        if "name" != key})
+
+
+def library_index(project_dir: str, manifest: dict) -> dict:
+    """
+    :param project_dir: The project directory.
+    :param manifest: The manifest.
+    :return: Dict of content_key to manifest entry, for the snippets of
+    the manifest's library.
+    """
+    library_dir = os.path.join(project_dir, manifest["library"])
+    result = {}
+    if not os.path.isdir(library_dir):
+        return result
+    for path in list_dir_snippets(library_dir):
+        with open(path) as fp:
+            key = content_key(json.load(fp))
+        result.setdefault(key, os.path.relpath(path, project_dir)[:-5])
+    return result
+
+
+def relink_target(project_dir: str, name: str) -> int:
+    """
+    After a script has been split into its directory, point its manifest
+    entries back at the library for the snippets the library holds, and
+    remove the copies split wrote.
+    :param project_dir: The project directory.
+    :param name: The script, such as X_ALL.
+    :return: The number of snippets relinked, or None if the manifest
+    doesn't list the script.
+    """
+    path = os.path.join(project_dir, manifest_name)
+    with open(path) as fp:
+        manifest = json.load(fp)
+    if name not in manifest["targets"]:
+        return None
+    index = library_index(project_dir, manifest)
+    entries = []
+    count = 0
+    for snippet_path in list_dir_snippets(os.path.join(project_dir, name)):
+        with open(snippet_path) as fp:
+            entry = index.get(content_key(json.load(fp)))
+        if entry is None:
+            entries.append(os.path.relpath(snippet_path, project_dir)[:-5])
+            continue
+        os.remove(snippet_path)
+        entries.append(entry)
+        count += 1
+    manifest["targets"][name] = entries
+    with open(path, "w") as fp:
+        json.dump(manifest, fp, indent=4)
+    return count
+
+
+class RenderCache(object):
+    """
+    Rendered snippet text, by snippet content.
+    attributes:
+    * registry : The templates to expand
+    * texts    : Dict of snippet_key to BAF text
+    """
+    def __init__(self, registry: TemplateRegistry):
+        self.registry = registry
+        self.texts = {}
+
+    def render(self, snippet: dict):
+        """
+        Return the text of a snippet, rendering it if it hasn't been yet.
+        :param snippet: The snippet.
+        :return: (text, True if it was already rendered).
+        """
+        key = snippet_key(snippet)
+        try:
+            return self.texts[key], True
+        except KeyError:
+            pass
+        text = convert_json_to_baf(snippet, self.registry)
+        self.texts[key] = text
+        return text, False
+
+
+def build_target(paths: list, target_file: str, cache: RenderCache) -> dict:
+    """
+    Write one target script.
+    :param paths: The snippet files, in script order.
+    :param target_file: The script to write.
+    :param cache: The rendered snippets shared between targets.
+    :return: A dict of statistics: snippets, blocks, reused, seconds.
+    """
+    stats = {"snippets": 0, "blocks": 0, "reused": 0, "seconds": 0.0}
+    out = []
+    for path in paths:
+        logging.info("Processing file '{}'".format(path))
+        with open(path) as fp:
+            snippet = json.load(fp)
+        start = time.perf_counter()
+        text, reused = cache.render(snippet)
+        stats["seconds"] += time.perf_counter() - start
+        out.append(text)
+        stats["snippets"] += 1
+        stats["blocks"] += row_count(snippet)
+        stats["reused"] += reused
+    logging.debug("Writing file '{}'".format(target_file))
+    with open(target_file, "w") as fp:
+        fp.write("".join(out))
+    return stats
+
+
+def build(project_dir: str, manifest: dict, registry: TemplateRegistry,
+          names: list = None) -> dict:
+    """
+    Write the target scripts of a manifest.
+    :param project_dir: The directory the manifest entries are relative to.
+    :param manifest: The manifest.
+    :param registry: The templates to expand.
+    :param names: The targets to build (default: all).
+    :return: A dict of target name to statistics, see build_target.
+    """
+    cache = RenderCache(registry)
+    result = {}
+    for name, entries in manifest["targets"].items():
+        if names and name.lower() not in names:
+            continue
+        target_file = os.path.join(project_dir, name + ".BAF")
+        result[name] = build_target(resolve_entries(project_dir, entries),
+                                    target_file, cache)
+    return result
+
+
+def init_manifest(project_dir: str, library: str = "library") -> dict:
+    """
+    Write a manifest for the scripts of a project.  Snippets used by more
+    than one script are moved to the library, which then holds their
+    only copy.  If the project already has a manifest, its entries are
+    the starting point, library references included, so running this
+    again only adds what has become shared since.
+    :param project_dir: The project directory.
+    :param library: The library directory, relative to project_dir, if
+    the project has no manifest yet.
+    :return: The manifest.
+    """
+    names = set()
+    try:
+        with open(os.path.join(project_dir, manifest_name)) as fp:
+            existing = json.load(fp)
+        library = existing["library"]
+        names.update(existing["targets"])
+    except OSError:
+        pass
+    for file_name in os.listdir(project_dir):
+        prefix, suffix = os.path.splitext(file_name)
+        if suffix.lower() == ".baf" and \
+                os.path.isdir(os.path.join(project_dir, prefix)):
+            names.add(prefix)
+    targets = {name: list_snippets(os.path.join(project_dir, name))
+               for name in sorted(names)}
+
+    users = {}
+    snippets = {}
+    for name, paths in targets.items():
+        for path in paths:
+            with open(path) as fp:
+                snippets[path] = json.load(fp)
+            users.setdefault(snippet_key(snippets[path]), set()).add(name)
+
+    library_dir = os.path.join(project_dir, library)
+    shared = {}
+    for paths in targets.values():
+        for path in paths:
+            entry = os.path.relpath(path, project_dir)[:-5]
+            if os.path.dirname(entry) == library:
+                shared.setdefault(snippet_key(snippets[path]), entry)
+    added = 0
+    manifest = {"library": library, "targets": {}}
+    for name, paths in targets.items():
+        entries = []
+        for path in paths:
+            snippet = snippets[path]
+            key = snippet_key(snippet)
+            entry = os.path.relpath(path, project_dir)[:-5]
+            if os.path.dirname(entry) == library or len(users[key]) < 2:
+                entries.append(entry)
+                continue
+            if key not in shared:
+                base = snippet.get("name") or \
+                    os.path.splitext(os.path.basename(path))[0]
+                entry = os.path.join(library, base)
+                count = 1
+                while entry in shared.values() or \
+                        os.path.exists(os.path.join(project_dir,
+                                                    entry + ".json")):
+                    count += 1
+                    entry = os.path.join(library,
+                                         "{}-{}".format(base, count))
+                os.makedirs(library_dir, exist_ok=True)
+                with open(os.path.join(project_dir, entry + ".json"),
+                          "w") as fp:
+                    json.dump(snippet, fp, indent=4, sort_keys=True)
+                shared[key] = entry
+                added += 1
+            os.remove(path)
+            entries.append(shared[key])
+        manifest["targets"][name] = entries
+    logging.warning("{} snippets shared between scripts, {} new".format(
+        len(shared), added))
+    return manifest
+
+
+if __name__ == "__main__":
+    search_dir = os.path.join(tools_dir, "..", project_name)
+    parser = argparse.ArgumentParser(
+        description="Build scripts from a manifest of shared snippets")
+    parser.add_argument('-v', '--verbose', action='count', default=0)
+    parser.add_argument('-d', '--search_dir', default=search_dir)
+    parser.add_argument('-m', '--manifest',
+                        help="Manifest file (default: search_dir/{})".format(
+                            manifest_name))
+    parser.add_argument('-t', '--templates',
+                        help="Directory holding if/then (default: search_dir)")
+    parser.add_argument('--no_cache', action='store_true',
+                        help="Don't use the compiled template cache")
+    parser.add_argument('--init', action='store_true',
+                        help="Move shared snippets to the library and write "
+                             "search_dir/{}".format(manifest_name))
+    parser.add_argument('names', nargs='*',
+                        help="Targets to build, such as X_PICK (default: all)")
+
+    args = parser.parse_args()
+    if args.verbose == 0:
+        level = logging.WARNING
+    elif args.verbose == 1:
+        level = logging.INFO
+    else:
+        level = logging.DEBUG
+    logging.basicConfig(stream=sys.stdout, level=level)
+
+    manifest_path = args.manifest or os.path.join(args.search_dir,
+                                                  manifest_name)
+    if args.init:
+        # Always the project's own manifest: it is the one combine and
+        # split read, and the only copy of the shared snippets is moved.
+        manifest = init_manifest(args.search_dir)
+        with open(os.path.join(args.search_dir, manifest_name), "w") as fp:
+            json.dump(manifest, fp, indent=4)
+        sys.exit(0)
+
+    with open(manifest_path) as fp:
+        manifest = json.load(fp)
+    registry = TemplateRegistry.load(args.templates or args.search_dir,
+                                     not args.no_cache)
+    results = build(args.search_dir, manifest, registry,
+                    [name.lower() for name in args.names])
+
+    print("{:<12} {:>8} {:>8} {:>8} {:>10}".format(
+        "target", "snippets", "blocks", "reused", "render ms"))
+    for name, stats in results.items():
+        print("{:<12} {:>8} {:>8} {:>8} {:>10.1f}".format(
+            name, stats["snippets"], stats["blocks"], stats["reused"],
+            stats["seconds"] * 1000))
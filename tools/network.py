@@ -0,0 +1,128 @@
+#! /usr/bin/env python3
+import logging
+
+from substituter import ElementRegex
+
+
+def line_head(line: str) -> str:
+    """
+    Return the discriminating head of a trigger or action line, which is
+    the text up to and including the first '('.
+    :param line: The line to examine.
+    :return: The head of the line.
+    """
+    index = line.find('(')
+    if index < 0:
+        return line
+    return line[:index + 1]
+
+
+def element_head(element: ElementRegex):
+    """
+    Return the head every line matching this element must have, or None
+    if the element starts with a field and so could match any line.
+    :param element: The regex element to examine.
+    :return: The head or None.
+    """
+    literal = element.element.split('<', 1)[0]
+    if '(' in literal:
+        return line_head(literal)
+    if literal == element.element:
+        return literal
+    return None
+
+
+class MatchNetwork(object):
+    """
+    A set of templates compiled into a single discrimination network.
+
+    Every distinct regex element across all templates becomes one shared
+    alpha node, indexed by the head of the lines it can match.  Each line
+    of the input is tested once against the nodes sharing its head, and a
+    template is only joined (matched in full) when all of its alpha nodes
+    have seen a line.  Templates are still tried greedily, largest first,
+    so the result is the same as trying every template in turn.
+    """
+    def __init__(self, substituters: list):
+        """
+        Build the network.
+        :param substituters: The Substituter objects to compile.
+        """
+        self.alpha = {}
+        self.heads = {}
+        self.wildcards = []
+        self.substituters = sorted(substituters,
+                                   key=lambda x: x.line_count(), reverse=True)
+        self.required = []
+        for substituter in self.substituters:
+            required = set()
+            self._share(substituter.template, required)
+            self.required.append(frozenset(required))
+
+        for node in self.alpha.values():
+            head = element_head(node)
+            if head is None:
+                self.wildcards.append(node)
+            else:
+                self.heads.setdefault(head, []).append(node)
+        logging.debug("Network: {} templates, {} alpha nodes".format(
+            len(self.substituters), len(self.alpha)))
+
+    def _share(self, element, required: set):
+        """
+        Replace the regex elements below element with the shared alpha
+        nodes, recording the nodes the template requires.
+        :param element: An ElementTemplate or ElementOR.
+        :param required: Set of alpha node keys to add to.
+        """
+        for i, child in enumerate(element.elements):
+            if isinstance(child, ElementRegex):
+                node = self.alpha.setdefault(child.element, child)
+                element.elements[i] = node
+                required.add(node.element)
+            else:
+                self._share(child, required)
+
+    def activate(self, list_in: list) -> set:
+        """
+        Feed every line of a list through the alpha nodes.
+        :param list_in: The list of lines (and OR lists) to test.
+        :return: The set of alpha node keys matching at least one line.
+        """
+        present = set()
+        for item in list_in:
+            lines = item if isinstance(item, list) else [item]
+            for line in lines:
+                if not isinstance(line, str):
+                    continue
+                for node in self.heads.get(line_head(line), ()):
+                    if node.element not in present and \
+                            node.search(line) is not None:
+                        present.add(node.element)
+                for node in self.wildcards:
+                    if node.element not in present and \
+                            node.search(line) is not None:
+                        present.add(node.element)
+        return present
+
+    def collapse(self, lists_in: list, fields_in: dict) -> (list, dict):
+        """
+        Collapse every template the network holds into a set of lists.
+        Each template is tried against each list in turn, exactly as if
+        Substituter.collapse were called for every template.
+        :param lists_in: The lists to collapse.
+        :param fields_in: Source fields to compare.
+        :return: The (possibly modified) lists and fields.
+        """
+        lists = list(lists_in)
+        fields = fields_in
+        present = [self.activate(item) for item in lists]
+        for substituter, required in zip(self.substituters, self.required):
+            for i, list_in in enumerate(lists):
+                if not required <= present[i]:
+                    continue
+                list_out, fields = substituter.collapse(list_in, fields)
+                if list_out is not list_in:
+                    lists[i] = list_out
+                    present[i] = self.activate(list_out)
+        return lists, fields
@@ -0,0 +1,160 @@
+#! /usr/bin/env python3
+import logging
+import os
+import sys
+import zlib
+
+from network import MatchNetwork
+from substituter import Substituter
+
+
+# The compiled template cache, kept next to the template directories.
+cache_name = ".template_cache.pickle"
+
+
+class TemplateRegistry(object):
+    """
+    The templates of one project, loaded from explicit directories.
+    Templates are loaded once and shared by everything using the registry.
+    attributes:
+    * trigger_dir : The directory holding the "if" templates
+    * action_dir  : The directory holding the "then" templates
+    """
+    def __init__(self, root: str = None, trigger_dir: str = None,
+                 action_dir: str = None):
+        """
+        Create a registry.
+        :param root: A project directory holding "if" and "then".
+        :param trigger_dir: The "if" directory, if not below root.
+        :param action_dir: The "then" directory, if not below root.
+        """
+        if trigger_dir is None:
+            trigger_dir = os.path.join(root, "if")
+        if action_dir is None:
+            action_dir = os.path.join(root, "then")
+        self.trigger_dir = os.path.realpath(trigger_dir)
+        self.action_dir = os.path.realpath(action_dir)
+        self.roots = [self.trigger_dir, self.action_dir]
+        self._substituters = {}
+        self._networks = {}
+
+    def substituter(self, name: str) -> Substituter:
+        """
+        Return the Substituter for a template, loading it on first use.
+        :param name: The name of the template.
+        :return: The Substituter.
+        """
+        try:
+            return self._substituters[name]
+        except KeyError:
+            pass
+        result = Substituter(name, self.roots)
+        self._substituters[name] = result
+        return result
+
+    def names(self, which: str) -> list:
+        """
+        Return the names of the templates in a template set.
+        :param which: Which template set, "if" or "then".
+        :return: A sorted list of template names.
+        """
+        dir_name = self.trigger_dir if "if" == which else self.action_dir
+        out = []
+        for file_name in os.listdir(dir_name):
+            prefix, suffix = os.path.splitext(file_name)
+            if ".json" == suffix:
+                out.append(prefix)
+        out.sort()
+        return out
+
+    def network(self, which: str) -> MatchNetwork:
+        """
+        Return the MatchNetwork for a template set, building it on first use.
+        :param which: Which template set, "if" or "then".
+        :return: The MatchNetwork.
+        """
+        try:
+            return self._networks[which]
+        except KeyError:
+            pass
+        substituters = [self.substituter(name) for name in self.names(which)]
+        for item in substituters:
+            logging.debug("{} : {} lines".format(item.template.name,
+                                                 item.line_count()))
+        result = MatchNetwork(substituters)
+        self._networks[which] = result
+        return result
+
+    def preload(self):
+        """
+        Load every template and build both networks, so that nothing is
+        left to load from disk later.
+        """
+        for which in ("if", "then"):
+            self.network(which)
+
+    def cache_key(self) -> str:
+        """
+        Return a hash of the template directories: the name, size and
+        modification time of every template in them, and of the modules
+        that define the cached classes.
+        :return: The hash, as hex.
+        """
+        # zlib is much cheaper to import than hashlib, and the cache
+        # saves little enough as it is.
+        crc = 0
+        for kind in (MatchNetwork, Substituter, TemplateRegistry):
+            stat = os.stat(sys.modules[kind.__module__].__file__)
+            crc = zlib.crc32("{}:{};".format(
+                kind.__name__, stat.st_mtime_ns).encode(), crc)
+        for dir_name in self.roots:
+            crc = zlib.crc32(dir_name.encode(), crc)
+            for entry in sorted(os.scandir(dir_name), key=lambda x: x.name):
+                if entry.name.endswith(".json"):
+                    stat = entry.stat()
+                    crc = zlib.crc32("{}:{}:{};".format(
+                        entry.name, stat.st_size, stat.st_mtime_ns).encode(),
+                        crc)
+        return "{:08x}".format(crc)
+
+    @classmethod
+    def load(cls, root: str, use_cache: bool = True) -> "TemplateRegistry":
+        """
+        Return a fully loaded registry for a project directory, from the
+        compiled template cache when it is still current.  A stale or
+        missing cache is rebuilt.  With xseries' 43 templates the cache
+        saves only a few milliseconds, about the noise of a run; it pays
+        off only for much larger template sets.
+        :param root: A project directory holding "if" and "then".
+        :param use_cache: If false, the cache is neither read nor written.
+        :return: The registry.
+        """
+        registry = cls(root)
+        if not use_cache:
+            registry.preload()
+            return registry
+
+        import pickle
+        key = registry.cache_key().encode()
+        cache_path = os.path.join(root, cache_name)
+        try:
+            with open(cache_path, "rb") as fp:
+                data = fp.read()
+        except OSError:
+            data = b""
+        cached_key, _, body = data.partition(b"\n")
+        if cached_key == key:
+            logging.debug("Using template cache '{}'".format(cache_path))
+            return pickle.loads(body)
+
+        logging.info("Building template cache '{}'".format(cache_path))
+        registry.preload()
+        temp_path = cache_path + ".tmp"
+        try:
+            with open(temp_path, "wb") as fp:
+                fp.write(key + b"\n")
+                fp.write(pickle.dumps(registry, pickle.HIGHEST_PROTOCOL))
+            os.replace(temp_path, cache_path)
+        except OSError as e:
+            logging.warning("Unable to write template cache: {}".format(e))
+        return registry
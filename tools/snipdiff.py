@@ -0,0 +1,281 @@
+#! /usr/bin/env python3
+import argparse
+from bisect import bisect_left
+import json
+import logging
+import os
+import sys
+
+from combine import convert_json_to_blocks, list_snippets
+from globals import tools_dir, project_name
+from registry import TemplateRegistry
+from split import collapse_if_then, parse_if_then
+
+
+class Row(object):
+    """
+    One block of a snippet tree, collapsed with the common templates.
+    attributes:
+    * key    : "<snippet>:<row>", where the block came from
+    * name   : The snippet name, if any
+    * IF     : The collapsed triggers
+    * THEN   : The collapsed actions
+    * fields : The field values of the block
+    * shape  : Canonical text of IF/THEN, equal for blocks that differ
+               only in their fields
+    * digest : Canonical text of IF/THEN and fields
+    """
+    __slots__ = ("key", "name", "IF", "THEN", "fields", "shape", "digest")
+
+    def __init__(self, key: str, name: str, data: dict):
+        self.key = key
+        self.name = name
+        self.IF = data["IF"]
+        self.THEN = data["THEN"]
+        self.fields = data["fields"][0]
+        self.shape = json.dumps([self.IF, self.THEN], sort_keys=True,
+                                separators=(",", ":"))
+        self.digest = self.shape + json.dumps(
+            self.fields, sort_keys=True, separators=(",", ":"))
+
+    def describe(self) -> str:
+        """
+        :return: The templates and top-level lines of the block, on one line.
+        """
+        def names(items):
+            for item in items:
+                if isinstance(item, dict):
+                    yield "<{}>".format(next(iter(item)))
+                elif isinstance(item, list):
+                    yield "OR({})".format(", ".join(names(item)))
+                else:
+                    yield item
+        actions = []
+        for response in self.THEN:
+            for weight, items in response.items():
+                actions.append("#{} {}".format(weight, ", ".join(names(items))))
+        return "IF {} THEN {}".format(", ".join(names(self.IF)),
+                                      "; ".join(actions))
+
+
+def load_rows(source_dir: str, registry: TemplateRegistry,
+              canonical: TemplateRegistry) -> list:
+    """
+    Load the blocks of a snippet tree.  Each block is rendered with the
+    tree's own templates and collapsed again with the canonical ones, so
+    that trees using different templates (or hand-edited snippets) compare
+    by what they do, not by how they were written.
+    :param source_dir: The directory holding the snippets.
+    :param registry: The templates of the tree.
+    :param canonical: The templates to compare with.
+    :return: A list of Row objects, in script order.
+    """
+    trigger_network = canonical.network("if")
+    action_network = canonical.network("then")
+    result = []
+    for file in list_snippets(source_dir):
+        with open(file) as fp:
+            snippet = json.load(fp)
+        base = os.path.splitext(os.path.basename(file))[0]
+        blocks = convert_json_to_blocks(snippet, registry)
+        for row, text in enumerate(blocks):
+            key = "{}:{}".format(base, row)
+            data = collapse_if_then(parse_if_then(text, key),
+                                    trigger_network, action_network)
+            result.append(Row(key, snippet.get("name"), data))
+    return result
+
+
+def lcs_pairs(a: list, b: list) -> list:
+    """
+    Return a longest common subsequence of two sequences, using the
+    Hunt-Szymanski reduction to a longest increasing subsequence.  This
+    takes O((n + r) log n) for r matching pairs, which is close to
+    O(n log n) when most items are distinct.
+    :param a: The first sequence of hashable items.
+    :param b: The second sequence.
+    :return: A list of (index in a, index in b) pairs, in order.
+    """
+    positions = {}
+    for j, value in enumerate(b):
+        positions.setdefault(value, []).append(j)
+
+    # tails[k] is the smallest index in b that ends a common subsequence
+    # of length k + 1; links[k] is the chain of pairs that forms it.
+    tails = []
+    links = []
+    for i, value in enumerate(a):
+        # Going backwards keeps two pairs from the same i out of one chain.
+        for j in reversed(positions.get(value, ())):
+            k = bisect_left(tails, j)
+            link = (i, j, links[k - 1] if k else None)
+            if k == len(tails):
+                tails.append(j)
+                links.append(link)
+            else:
+                tails[k] = j
+                links[k] = link
+
+    result = []
+    link = links[-1] if links else None
+    while link:
+        result.append((link[0], link[1]))
+        link = link[2]
+    result.reverse()
+    return result
+
+
+def diff_rows(left: list, right: list) -> dict:
+    """
+    Compare two lists of blocks.  Blocks on the longest common
+    subsequence are unchanged.  Of the rest, blocks found on both sides
+    are moved, and blocks with the same IF/THEN but different fields are
+    changed (paired with a block of the same snippet name when possible).
+    :param left: The old blocks.
+    :param right: The new blocks.
+    :return: A dict with "unchanged", "moved" and "changed" lists of
+    (left, right) index pairs and "removed" and "inserted" lists of indexes.
+    """
+    # Trim the common ends first; most edits are local.
+    start = 0
+    while start < len(left) and start < len(right) and \
+            left[start].digest == right[start].digest:
+        start += 1
+    end = 0
+    while end < len(left) - start and end < len(right) - start and \
+            left[-1 - end].digest == right[-1 - end].digest:
+        end += 1
+
+    ids = {}
+    a = [ids.setdefault(row.digest, len(ids))
+         for row in left[start:len(left) - end]]
+    b = [ids.setdefault(row.digest, len(ids))
+         for row in right[start:len(right) - end]]
+    unchanged = [(i, i) for i in range(start)]
+    unchanged += [(i + start, j + start) for i, j in lcs_pairs(a, b)]
+    unchanged += [(len(left) - end + i, len(right) - end + i)
+                  for i in range(end)]
+
+    left_rest = set(range(len(left))) - set(i for i, _ in unchanged)
+    right_rest = set(range(len(right))) - set(j for _, j in unchanged)
+
+    def pair(key):
+        waiting = {}
+        for j in sorted(right_rest):
+            waiting.setdefault(key(right[j]), []).append(j)
+        result = []
+        for i in sorted(left_rest):
+            candidates = waiting.get(key(left[i]))
+            if candidates:
+                j = candidates.pop(0)
+                result.append((i, j))
+                left_rest.discard(i)
+                right_rest.discard(j)
+        return result
+
+    moved = pair(lambda row: row.digest)
+    changed = pair(lambda row: (row.shape, row.name))
+    changed += pair(lambda row: row.shape)
+    changed.sort(key=lambda item: item[1])
+    return {
+        "unchanged": unchanged,
+        "moved": moved,
+        "changed": changed,
+        "removed": sorted(left_rest),
+        "inserted": sorted(right_rest),
+    }
+
+
+def field_changes(old: dict, new: dict) -> list:
+    """
+    :return: A list of "FIELD: 'old' -> 'new'" strings.
+    """
+    result = []
+    for key in sorted(set(old) | set(new)):
+        if old.get(key) != new.get(key):
+            result.append("{}: {!r} -> {!r}".format(
+                key, old.get(key), new.get(key)))
+    return result
+
+
+def report(left: list, right: list, result: dict, fp=sys.stdout):
+    """
+    Write a diff as text, in the order of the right-hand script.  Removed
+    blocks are listed where they were, between the unchanged blocks
+    around them.
+    :param left: The old blocks.
+    :param right: The new blocks.
+    :param result: The result of diff_rows.
+    :param fp: Where to write.
+    """
+    partner = {}
+    for kind in ("moved", "changed"):
+        for i, j in result[kind]:
+            partner[j] = (kind, i)
+    removed = set(result["removed"])
+    inserted = set(result["inserted"])
+
+    anchors = result["unchanged"] + [(len(left), len(right))]
+    i = j = 0
+    for next_i, next_j in anchors:
+        for k in range(i, next_i):
+            if k in removed:
+                fp.write("- {} {}\n    {}\n".format(
+                    left[k].key, left[k].name or "", left[k].describe()))
+        for k in range(j, next_j):
+            row = right[k]
+            if k in inserted:
+                fp.write("+ {} {}\n    {}\n".format(
+                    row.key, row.name or "", row.describe()))
+            elif "moved" == partner[k][0]:
+                fp.write("> {} -> {} {}\n".format(
+                    left[partner[k][1]].key, row.key, row.name or ""))
+            else:
+                old = left[partner[k][1]]
+                fp.write("~ {} -> {} {}\n    {}\n".format(
+                    old.key, row.key, row.name or "", row.describe()))
+                for line in field_changes(old.fields, row.fields):
+                    fp.write("    {}\n".format(line))
+        i, j = next_i + 1, next_j + 1
+
+    fp.write("{} unchanged, {} moved, {} changed, {} removed, "
+             "{} inserted\n".format(*(len(result[kind]) for kind in (
+                 "unchanged", "moved", "changed", "removed", "inserted"))))
+
+
+if __name__ == "__main__":
+    search_dir = os.path.join(tools_dir, "..")
+    parser = argparse.ArgumentParser(
+        description="Compare two snippet trees block by block")
+    parser.add_argument('-v', '--verbose', action='count', default=0)
+    parser.add_argument('-t', '--templates',
+                        help="Directory holding the if/then to compare with "
+                             "(default: the new tree's project)")
+    parser.add_argument('old', help="Snippet directory, such as stock/BDDEFAI")
+    parser.add_argument('new', nargs='?',
+                        default=os.path.join(search_dir, project_name,
+                                             "BDDEFAI"),
+                        help="Snippet directory (default: {}/BDDEFAI)".format(
+                            project_name))
+
+    args = parser.parse_args()
+    if args.verbose == 0:
+        level = logging.WARNING
+    elif args.verbose == 1:
+        level = logging.INFO
+    else:
+        level = logging.DEBUG
+    logging.basicConfig(stream=sys.stdout, level=level)
+
+    # Each tree is rendered with the templates of its own project.
+    old_registry = TemplateRegistry.load(
+        os.path.dirname(os.path.realpath(args.old)))
+    new_registry = TemplateRegistry.load(
+        os.path.dirname(os.path.realpath(args.new)))
+    canonical = new_registry
+    if args.templates:
+        canonical = TemplateRegistry.load(args.templates)
+
+    old_rows = load_rows(args.old, old_registry, canonical)
+    new_rows = load_rows(args.new, new_registry, canonical)
+    report(old_rows, new_rows, diff_rows(old_rows, new_rows))
@@ -0,0 +1,223 @@
+#! /usr/bin/env python3
+import argparse
+from fnmatch import fnmatchcase
+import json
+import logging
+import os
+import sys
+import time
+import zlib
+
+from globals import tools_dir
+
+# The index, kept in the top directory it covers.
+index_name = ".snippet_index.json"
+
+# Bump when the terms indexed change, so old indexes are rebuilt.
+index_version = 1
+
+# The kinds of term indexed.
+kinds = ("spell", "global", "timer", "string", "template")
+
+# The modules that decide what a snippet renders to and what is indexed.
+_modules = ("combine.py", "commute.py", "split.py", "substituter.py",
+            "indexer.py")
+
+
+def list_json(directory: str) -> list:
+    """
+    :return: The sorted paths of the .json files in a directory.
+    """
+    return sorted(entry.path for entry in os.scandir(directory)
+                  if entry.name.endswith(".json") and entry.is_file())
+
+
+def project_stamp(project: str) -> str:
+    """
+    Return a hash of what the blocks of a project's snippets depend on
+    besides the snippets: its templates and the tools' own modules.
+    Only file names, sizes and modification times are read, so checking
+    an index needs nothing imported.
+    :param project: The project directory.
+    :return: The hash, as hex.
+    """
+    crc = 0
+    paths = [os.path.join(tools_dir, name) for name in _modules]
+    paths += list_json(os.path.join(project, "if"))
+    paths += list_json(os.path.join(project, "then"))
+    for path in paths:
+        stat = os.stat(path)
+        crc = zlib.crc32("{}:{}:{};".format(
+            os.path.basename(path), stat.st_size, stat.st_mtime_ns).encode(),
+            crc)
+    return "{:08x}".format(crc)
+
+
+def find_projects(root: str) -> list:
+    """
+    Return the project directories (those holding "if" and "then") at or
+    just below a directory.
+    :param root: The directory to look in.
+    :return: A sorted list of paths.
+    """
+    result = []
+    for path in [root] + sorted(os.path.join(root, name)
+                                for name in os.listdir(root)):
+        if os.path.isdir(os.path.join(path, "if")) and \
+                os.path.isdir(os.path.join(path, "then")):
+            result.append(path)
+    return result
+
+
+def snippet_dirs(project: str) -> list:
+    """
+    :return: The snippet directories of a project.
+    """
+    result = []
+    for name in sorted(os.listdir(project)):
+        path = os.path.join(project, name)
+        if name not in ("if", "then") and os.path.isdir(path) and \
+                list_json(path):
+            result.append(path)
+    return result
+
+
+class SnippetIndex(object):
+    """
+    An inverted index from spells, globals, timers, string IDs and
+    template names to the blocks that use them.  Each snippet file is
+    indexed on its own and re-indexed only when its size or modification
+    time changes (or its project's templates do).
+    attributes:
+    * root     : The directory the index covers; paths are relative to it
+    * projects : Dict of project path to its project_stamp
+    * files    : Dict of snippet path to {"stat": [size, mtime],
+                 "blocks": [[row, name, terms], ...]}
+    """
+    def __init__(self, root: str):
+        self.root = os.path.realpath(root)
+        self.projects = {}
+        self.files = {}
+
+    @classmethod
+    def load(cls, root: str) -> "SnippetIndex":
+        """
+        Load the index of a directory, or an empty one if it has none.
+        """
+        result = cls(root)
+        try:
+            with open(os.path.join(result.root, index_name)) as fp:
+                data = json.load(fp)
+        except (OSError, ValueError):
+            return result
+        if index_version == data.get("version"):
+            result.projects = data["projects"]
+            result.files = data["files"]
+        return result
+
+    def save(self):
+        """
+        Write the index, replacing the old one atomically.
+        """
+        path = os.path.join(self.root, index_name)
+        try:
+            with open(path + ".tmp", "w") as fp:
+                json.dump({"version": index_version, "projects": self.projects,
+                           "files": self.files}, fp)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            logging.warning("Unable to write index: {}".format(e))
+
+    def update(self) -> int:
+        """
+        Bring the index up to date with the snippet files on disk.
+        :return: The number of files (re)indexed.
+        """
+        count = 0
+        seen = set()
+        for project in find_projects(self.root):
+            name = os.path.relpath(project, self.root)
+            key = project_stamp(project)
+            stale = self.projects.get(name) != key
+            self.projects[name] = key
+            registry = None
+            for directory in snippet_dirs(project):
+                for path in list_json(directory):
+                    rel = os.path.relpath(path, self.root)
+                    seen.add(rel)
+                    stat = os.stat(path)
+                    stamp = [stat.st_size, stat.st_mtime_ns]
+                    entry = self.files.get(rel)
+                    if not stale and entry and entry["stat"] == stamp:
+                        continue
+                    if registry is None:
+                        import indexer
+                        from registry import TemplateRegistry
+                        registry = TemplateRegistry.load(project)
+                    logging.info("Indexing '{}'".format(rel))
+                    self.files[rel] = {
+                        "stat": stamp,
+                        "blocks": indexer.index_file(path, registry)}
+                    count += 1
+        for rel in set(self.files) - seen:
+            del self.files[rel]
+            count += 1
+        return count
+
+    def query(self, kind: str, pattern: str) -> list:
+        """
+        Find the blocks that name a term.
+        :param kind: One of kinds.
+        :param pattern: The term; may hold shell wildcards.  Case is ignored.
+        :return: A sorted list of (block key, snippet name, matching terms).
+        """
+        pattern = pattern.upper()
+        wild = any(char in pattern for char in "*?[")
+        result = []
+        for rel, entry in self.files.items():
+            for row, name, terms in entry["blocks"]:
+                if wild:
+                    found = [term for term in terms[kind]
+                             if fnmatchcase(term, pattern)]
+                else:
+                    found = [pattern] if pattern in terms[kind] else []
+                if found:
+                    key = "{}:{}".format(os.path.splitext(rel)[0], row)
+                    result.append((key, name, found))
+        result.sort()
+        return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Find the blocks that use a spell, global, timer, "
+                    "string ID or template")
+    parser.add_argument('-v', '--verbose', action='count', default=0)
+    parser.add_argument('-r', '--root', default=os.path.join(tools_dir, ".."),
+                        help="Directory holding the projects (default: the "
+                             "repository)")
+    parser.add_argument('--rebuild', action='store_true',
+                        help="Index every file again")
+    parser.add_argument('kind', nargs='?', choices=kinds)
+    parser.add_argument('term', nargs='?',
+                        help="The term; shell wildcards are allowed")
+
+    args = parser.parse_args()
+    if args.verbose == 0:
+        level = logging.WARNING
+    elif args.verbose == 1:
+        level = logging.INFO
+    else:
+        level = logging.DEBUG
+    logging.basicConfig(stream=sys.stdout, level=level)
+
+    start = time.perf_counter()
+    index = SnippetIndex(args.root) if args.rebuild \
+        else SnippetIndex.load(args.root)
+    if index.update():
+        index.save()
+    if args.kind and args.term:
+        for key, name, found in index.query(args.kind, args.term):
+            print("{}  {}  {}".format(key, name or "", ", ".join(found)))
+    logging.info("Answered in {:.1f} ms".format(
+        (time.perf_counter() - start) * 1000))
@@ -3,38 +3,17 @@ import argparse
 import json
 import logging
 import os
-import pprint
 import re
-import shutil
 import sys
 
-from substituter import Substituter
 from globals import tools_dir, project_name
+from registry import TemplateRegistry
 
 
 # This breaks a statement into an if and a then block
 _if_then_regex = r"(?P<statement>IF(?P<IF>(.|\n)*?)^THEN$(?P<THEN>(.|\n)*?)END)"
 
 
-def _load_templates(which: str):
-    """
-    Return a list of applicable templates
-    :param which: Which template set to load, "if" or "then"
-    """
-    out = []
-    dir_name = os.path.join(tools_dir, "..", project_name, which)
-    for file_name in os.listdir(dir_name):
-        prefix, suffix = os.path.splitext(file_name)
-        if ".json" == suffix:
-            out.append(Substituter(prefix))
-    out.sort(key=lambda x: x.line_count(), reverse=True)
-
-    for item in out:
-        logging.debug("{} : {} lines".format(item.template.name,
-                                             item.line_count()))
-    return out
-
-
 def promote_trigger(source: list, trigger: str) -> list:
     """Move items matching the trigger regex to the start of the returned list"""
     result = []
@@ -47,31 +26,6 @@ def promote_trigger(source: list, trigger: str) -> list:
     return result
 
 
-def split_file(source_file: str, target_dir: str) -> list:
-    """Split a script file into component pieces"""
-    logging.info("Creating directory '{}'".format(target_dir))
-    os.makedirs(target_dir)
-
-    logging.debug("Loading file '{}'".format(source_file))
-    with open(source_file) as f:
-        source_text = f.read()
-    logging.debug("Read {} bytes".format(len(source_text)))
-
-    r = re.compile(_if_then_regex, flags=re.MULTILINE)
-    count = 0
-    outputs = []
-    for m in r.finditer(source_text):
-        count = count + 1
-        # It's not json... yet.  But it will be after split_if_then.
-        output_name = os.path.join(target_dir, "{:04}.json".format(count*10))
-        with open(output_name, "w") as f:
-            f.write(m.groupdict()["statement"])
-        outputs.append(output_name)
-    logging.info("Found {} statements".format(count))
-
-    return outputs
-
-
 def replace_double_quotes_with_single_outside_comment(data: str) -> str:
     """"
     Replace double quotes in non-comment with single quotes.
@@ -134,13 +88,34 @@ def get_name(actions: list):
     return name
 
 
-def split_if_then(source_file: str) -> dict:
-    """Split a script file into component pieces"""
-    logging.debug("Splitting '{}' into IF/THEN blocks".format(source_file))
-    with open(source_file) as f:
-        source_text = f.read()
-    logging.debug("Read {} bytes".format(len(source_text)))
+def iter_statements(lines):
+    """
+    Stream IF/THEN statements out of a script one at a time, so a script
+    never has to be held in memory as a whole.
+    :param lines: An iterable of script lines (such as an open file).
+    :return: A generator of statement strings.
+    """
+    statement = None
+    for line in lines:
+        stripped = line.strip()
+        if statement is None:
+            if stripped.startswith("IF"):
+                statement = [line]
+        else:
+            statement.append(line)
+            if "END" == stripped:
+                yield "".join(statement)
+                statement = None
 
+
+def parse_if_then(source_text: str, source_name: str = "<text>") -> dict:
+    """
+    Split a single IF/THEN statement into component pieces.  Lines are
+    interned, since the same trigger text repeats across many blocks.
+    :param source_text: The text of the statement.
+    :param source_name: Where the text came from, for error messages.
+    :return: A dict with "IF", "THEN" and possibly "name".
+    """
     r = re.compile(_if_then_regex, flags=re.MULTILINE)
     r_or = re.compile(r"OR\((\d+)\)")
     r_resp = re.compile(r"RESPONSE #(\d+)")
@@ -158,7 +133,7 @@ def split_if_then(source_file: str) -> dict:
         or_count = 0
         # Break if conditions into separate lines.
         for line in m.group("IF").split('\n'):
-            line = line.strip()
+            line = sys.intern(line.strip())
             or_check = r_or.match(line)
 
             if 0 == len(line):
@@ -178,7 +153,7 @@ def split_if_then(source_file: str) -> dict:
         action_list = []
         response_value = None
         for line in m.group("THEN").split('\n'):
-            line = line.strip()
+            line = sys.intern(line.strip())
             response_check = r_resp.match(line)
             if 0 == len(line):
                 pass
@@ -194,7 +169,7 @@ def split_if_then(source_file: str) -> dict:
 
     if count > 1:
         raise RuntimeError("IF/THEN Parse found multiple matches in '{}'"
-                           .format(source_file))
+                           .format(source_name))
 
     # triggers = promote_trigger(triggers, "^HaveSpell")
     # triggers = promote_trigger(triggers, "^ActionListEmpty")
@@ -205,6 +180,124 @@ def split_if_then(source_file: str) -> dict:
     return result
 
 
+def collapse_if_then(data: dict, trigger_network, action_network) -> dict:
+    """
+    Collapse templates into a parsed IF/THEN statement.
+    :param data: The statement from parse_if_then (modified in place).
+    :param trigger_network: MatchNetwork of "if" templates.
+    :param action_network: MatchNetwork of "then" templates.
+    :return: The statement, with a single "fields" entry added.
+    """
+    (data["IF"],), fields = trigger_network.collapse([data["IF"]], {})
+    keys = []
+    for response in data["THEN"]:
+        assert 1 == len(response)
+        keys.append(next(iter(response)))
+    values, fields = action_network.collapse(
+        [response[key] for response, key in zip(data["THEN"], keys)],
+        fields)
+    for response, key, value in zip(data["THEN"], keys, values):
+        response[key] = value
+    data["fields"] = [fields]
+    return data
+
+
+def parse_baf(source_text: str) -> list:
+    """
+    Parse a script into its IF/THEN statements.
+    :param source_text: The text of the script.
+    :return: A list of statement dicts, see parse_if_then.
+    """
+    return [parse_if_then(statement)
+            for statement in iter_statements(source_text.splitlines(True))]
+
+
+def iter_collapse(blocks, registry: TemplateRegistry):
+    """
+    Collapse templates into parsed statements, merging adjacent statements
+    with the same IF/THEN into one snippet with several field rows.  A
+    merged snippet keeps the name of its last statement.
+    :param blocks: An iterable of statements from parse_if_then.
+    :param registry: The templates to collapse.
+    :return: A generator of snippet dicts.
+    """
+    trigger_network = registry.network("if")
+    action_network = registry.network("then")
+    prev = None
+    for data in blocks:
+        data = collapse_if_then(data, trigger_network, action_network)
+        if prev and prev["IF"] == data["IF"] and \
+                prev["THEN"] == data["THEN"]:
+            data["fields"] = prev["fields"] + data["fields"]
+        elif prev:
+            yield prev
+        prev = data
+    if prev:
+        yield prev
+
+
+def collapse(blocks: list, registry: TemplateRegistry) -> list:
+    """
+    Collapse templates into parsed statements, see iter_collapse.
+    :param blocks: A list of statements from parse_if_then.
+    :param registry: The templates to collapse.
+    :return: A list of snippet dicts.
+    """
+    return list(iter_collapse(blocks, registry))
+
+
+def block_templates(data: dict) -> list:
+    """
+    Return the names of the templates a collapsed block uses directly: in
+    its IF, its OR groups and its responses.  Templates nested inside
+    those are not included.
+    :param data: The collapsed block.
+    :return: A list of names, in block order, without duplicates.
+    """
+    items = list(data["IF"])
+    for response in data["THEN"]:
+        items += next(iter(response.values()))
+    result = []
+    for item in items:
+        for entry in item if isinstance(item, list) else [item]:
+            if isinstance(entry, dict):
+                name = next(iter(entry))
+                if name not in result:
+                    result.append(name)
+    return result
+
+
+def compact_fields(data: dict) -> dict:
+    """
+    Store the field rows of a multi-row snippet as the values every row
+    shares plus a table of the values that vary:
+        "shared": {name: value},
+        "rows": {"keys": [names], "values": [[row values], ...]}
+    Snippets with one row, or rows with different field names, are left
+    with their "fields" list.
+    :param data: The snippet (modified in place).
+    :return: The snippet.
+    """
+    rows = data["fields"]
+    if len(rows) < 2:
+        return data
+    names = set(rows[0])
+    if any(set(row) != names for row in rows):
+        return data
+    shared = {}
+    for name, value in rows[0].items():
+        if all(row[name] == value for row in rows):
+            shared[name] = value
+    keys = sorted(names - set(shared))
+    del data["fields"]
+    data["shared"] = shared
+    data["rows"] = {
+        "keys": keys,
+        "values": [[row[key] for key in keys] for row in rows],
+    }
+    return data
+
+
 def get_history_names(snips_dir: str) -> dict:
     """
     Build a dictionary of names to if-then pairs from a previous run.
@@ -236,11 +329,12 @@ def get_history_names(snips_dir: str) -> dict:
     return result
 
 
-def split(source: str, auto_delete: bool):
+def split(source: str, auto_delete: bool, registry: TemplateRegistry):
     """
     Split a source file into a subdirectory of similar name.
     :param source: The source file, including path.
     :param auto_delete: If true, the snips directory will be removed.
+    :param registry: The templates to collapse.
     :return: None.
     """
     target = os.path.splitext(source)[0]
@@ -249,30 +343,22 @@ def split(source: str, auto_delete: bool):
     logging.info("Target = '{}'".format(target))
 
     history = get_history_names(target)
-    # logging.debug("History = {}".format(pprint.pformat(history)))
 
-    if args.auto_delete and os.path.isdir(target):
+    if auto_delete and os.path.isdir(target):
+        import shutil
         logging.warning("Removing directory '{}'".format(target))
         shutil.rmtree(target, ignore_errors=True)
-    files_to_split = split_file(source, target)
-
-    trigger_templates = _load_templates("if")
-    action_templates = _load_templates("then")
-
-    files_to_merge = []
-
-    for file in files_to_split:
-        data = split_if_then(file)
-        fields = {}
-        for template in trigger_templates:
-            data["IF"], fields = template.collapse(data["IF"], fields)
-        for template in action_templates:
-            for response in data["THEN"]:
-                assert 1 == len(response)
-                for key, value in response.items():
-                    response[key], fields = template.collapse(
-                        value, fields)
-        data["fields"] = [fields]
+    logging.info("Creating directory '{}'".format(target))
+    os.makedirs(target)
+
+    logging.debug("Loading file '{}'".format(source))
+    with open(source) as f:
+        source_text = f.read()
+    logging.debug("Read {} bytes".format(len(source_text)))
+
+    count = 0
+    for data in iter_collapse(parse_baf(source_text), registry):
+        count = count + len(data["fields"])
 
         # If this was in the history with a name, keep the name.
         for item in history:
@@ -280,41 +366,22 @@ def split(source: str, auto_delete: bool):
                 data["name"] = item["name"]
                 break
 
+        # Snippets are numbered by the last statement they hold.
+        file_name = "{:04}".format(count * 10)
         if "name" in data:
-            source = file
-            prefix, postfix = os.path.splitext(file)
-            dest = prefix + "-" + data["name"] + postfix
-            file = dest
-            os.remove(source)
-
-        with open(file, "w") as fp:
-            json.dump(data, fp, indent=4, sort_keys=True)
-            files_to_merge.append(file)
-
-    prev_file = None
-    prev_data = None
-    for curr_file in files_to_merge:
-        with open(curr_file) as fp:
-            curr_data = json.load(fp)
-
-        if prev_data and prev_data["IF"] == curr_data["IF"] and \
-                prev_data["THEN"] == curr_data["THEN"]:
-            logging.debug("left: {}".format(pprint.pformat(
-                curr_data["fields"]
-            )))
-            logging.debug("right: {}".format(pprint.pformat(
-                prev_data["fields"]
-            )))
-            curr_data["fields"] = prev_data["fields"] + curr_data["fields"]
-            logging.debug("both: {}".format(pprint.pformat(
-                curr_data["fields"]
-            )))
-            with open(curr_file, "w") as fp:
-                json.dump(curr_data, fp, indent=4, sort_keys=True)
-            os.remove(prev_file)
-
-        prev_file = curr_file
-        prev_data = curr_data
+            file_name = file_name + "-" + data["name"]
+        path = os.path.join(target, file_name + ".json")
+        with open(path, "w") as fp:
+            json.dump(compact_fields(data), fp, indent=4, sort_keys=True)
+    logging.info("Found {} statements".format(count))
+
+    from combine import manifest_name
+    project_dir, name = os.path.split(target)
+    if os.path.isfile(os.path.join(project_dir, manifest_name)):
+        from manifest import relink_target
+        relinked = relink_target(project_dir, name)
+        if relinked is not None:
+            logging.info("Relinked {} shared snippets".format(relinked))
 
 
 if __name__ == "__main__":
@@ -324,6 +391,10 @@ if __name__ == "__main__":
     parser.add_argument('--auto_delete', action='store_true', default=True)
     parser.add_argument('-v', '--verbose', action='count', default=0)
     parser.add_argument('-d', '--search_dir', default=search_dir)
+    parser.add_argument('-t', '--templates',
+                        help="Directory holding if/then (default: search_dir)")
+    parser.add_argument('--no_cache', action='store_true',
+                        help="Don't use the compiled template cache")
 
     args = parser.parse_args()
     if args.verbose == 0:
@@ -335,7 +406,9 @@ if __name__ == "__main__":
     logging.basicConfig(stream=sys.stdout, level=level)
     logging.info("Verbosity = {}".format(logging.getLevelName(level)))
 
+    registry = TemplateRegistry.load(args.templates or args.search_dir,
+                                     not args.no_cache)
     for file_name in os.listdir(args.search_dir):
         if file_name.lower().endswith('.baf'):
             file_path = os.path.realpath(os.path.join(args.search_dir, file_name))
-            split(file_path, args.auto_delete)
+            split(file_path, args.auto_delete, registry)
@@ -1,13 +1,10 @@
 #! /usr/bin/env python3
-from copy import deepcopy
 import json
 import logging
 import os
-import pprint
 import re
 
-_this_dir = os.path.dirname(os.path.realpath(__file__))
-app_name = "xseries"
+from globals import LazyFormat
 
 
 def combine_dicts(dict1, dict2):
@@ -24,23 +21,46 @@ def combine_dicts(dict1, dict2):
             return None
         result[key] = value
 
-    logging.debug("combine: dict1 = {}".format(pprint.pformat(dict1)))
-    logging.debug("combine: dict2 = {}".format(pprint.pformat(dict2)))
-    logging.debug("combine: result = {}".format(pprint.pformat(result)))
+    logging.debug("combine: dict1 = %s", LazyFormat(dict1))
+    logging.debug("combine: dict2 = %s", LazyFormat(dict2))
+    logging.debug("combine: result = %s", LazyFormat(result))
     return result
 
 
-def get_json_path(name: str) -> str:
+def get_json_path(name: str, roots: list) -> str:
     """
-    Return the path to the JSON file for the provided name.  This
-    is hackery because I didn't design things correctly.
+    Return the path to the JSON file for the provided name.
     :param name: Name of the template file.
+    :param roots: The template directories to search, in order.
     :return: The path to the template file.
     """
-    path = os.path.join(_this_dir, "..", app_name, "if", name + ".json")
-    if not os.path.exists(path):
-        path = os.path.join(_this_dir, "..", app_name, "then", name + ".json")
-    return os.path.realpath(path)
+    for root in roots:
+        path = os.path.join(root, name + ".json")
+        if os.path.exists(path):
+            return os.path.realpath(path)
+    raise FileNotFoundError("No template '{}' in {}".format(name, roots))
+
+
+def bipartite_match(options: list) -> bool:
+    """
+    Return True if every element can be given a line of its own.
+    :param options: For each element, the indexes of the lines it may take.
+    :return: True if there is a matching that covers every element.
+    """
+    owner = {}
+
+    def augment(k: int, seen: set) -> bool:
+        # Kuhn's augmenting path: take a free line, or move its owner.
+        for j in options[k]:
+            if j in seen:
+                continue
+            seen.add(j)
+            if j not in owner or augment(owner[j], seen):
+                owner[j] = k
+                return True
+        return False
+
+    return all(augment(k, set()) for k in range(len(options)))
 
 
 class ElementMatch(object):
@@ -51,17 +71,26 @@ class ElementMatch(object):
     * fields : A dict of field names and values from the match
     * after  : A list of unmatched elements after the match
     """
-    before = None
-    fields = {}
-    after = None
+    __slots__ = ("before", "fields", "after")
+
+    def __init__(self, before: list = None, fields: dict = None,
+                 after: list = None):
+        self.before = before
+        self.fields = {} if fields is None else fields
+        self.after = after
 
 
 class ElementRegex(object):
     """
     A regular expression used as a trigger or action element.
     """
+    __slots__ = ("element", "field_names", "source", "regex", "memo")
     key_regex = re.compile(r"<(\w+)>")
 
+    # Lines remembered per element before the memo is flushed, which
+    # keeps memory bounded when streaming a large corpus.
+    memo_limit = 65536
+
     def __init__(self, element: str):
         assert isinstance(element, str), "Regex element must be a string"
         self.element = element
@@ -72,7 +101,38 @@ class ElementRegex(object):
             named_group = "(?P<{}>.*)".format(field)
             field_name = re.escape("<{}>".format(field))
             escaped = escaped.replace(field_name, named_group)
-        self.regex = re.compile(escaped)
+        # Compiled on first use: rendering never needs the regex.
+        self.source = escaped
+        self.regex = None
+        self.memo = {}
+
+    def __getstate__(self):
+        return self.element, self.field_names, self.source
+
+    def __setstate__(self, state):
+        self.element, self.field_names, self.source = state
+        self.regex = None
+        self.memo = {}
+
+    def search(self, entry: str):
+        """
+        Test a single line against this element.  Results are remembered
+        per line, so a line is only ever tested once by each element.
+        :param entry: The line to test.
+        :return: None or a dict of field names and values.
+        """
+        try:
+            return self.memo[entry]
+        except KeyError:
+            pass
+        if self.regex is None:
+            self.regex = re.compile(self.source)
+        match = self.regex.search(entry)
+        groups = match.groupdict() if match else None
+        if len(self.memo) >= ElementRegex.memo_limit:
+            self.memo.clear()
+        self.memo[entry] = groups
+        return groups
 
     def match(self, inputs_in: list, fields_in: dict) -> ElementMatch:
         """
@@ -81,25 +141,23 @@ class ElementRegex(object):
         :param fields_in:  Source fields to compare.
         :return: None or an ElementMatch object.
         """
+        from copy import deepcopy
         fields = deepcopy(fields_in)
 
         for i, entry in enumerate(inputs_in):
             if isinstance(entry, str):
-                match = self.regex.search(entry)
-                if match:
+                groups = self.search(entry)
+                if groups is not None:
 
-                    combined_fields = combine_dicts(fields, match.groupdict())
+                    combined_fields = combine_dicts(fields, groups)
                     if combined_fields is None:
                         # We found a match, but we have a named parameter that
                         # holds two different values.  That fails the match.
                         logging.debug("{}: Element has conflict".format(
                             self.element))
-                        logging.debug("match fields = '{}'".format(
-                            pprint.pformat( match.groupdict())
-                        ))
-                        logging.debug("fields = '{}'".format(
-                            pprint.pformat(fields)
-                        ))
+                        logging.debug("match fields = '%s'",
+                                      LazyFormat(groups))
+                        logging.debug("fields = '%s'", LazyFormat(fields))
                         continue
 
                     logging.debug("'{}' == '{}'".format(
@@ -141,7 +199,9 @@ class ElementOR(object):
     """
     A list of elements joined together as an OR
     """
-    def __init__(self, elements):
+    __slots__ = ("elements",)
+
+    def __init__(self, elements, roots: list):
         self.elements = []
 
         for element in elements:
@@ -153,14 +213,108 @@ class ElementOR(object):
                 assert 1 == len(element), "template can only have one dict entry"
                 key, value = next(iter(element.items()))
                 assert {} == value, "template dict must be empty"
-                self.elements.append(ElementTemplate(key))
+                self.elements.append(ElementTemplate(key, roots))
             else:
-                pprint.pprint(element)
+                logging.error("Bad OR element %s", LazyFormat(element))
                 assert False, "unknown data type {} in OR list".format(
                     type(element)
                 )
-        logging.debug("ElementOR(): Added {}".format(pprint.pformat(
-            self.elements)))
+        logging.debug("ElementOR(): Added %s", LazyFormat(self.elements))
+
+    def line_fields(self, element, line, fields_in: dict):
+        """
+        Test one line of a candidate OR against one of our elements.
+        :param element: The element.
+        :param line: The line.
+        :param fields_in: The fields bound so far.
+        :return: None, or the fields the line binds (which agree with
+        fields_in).
+        """
+        if isinstance(element, ElementRegex):
+            if not isinstance(line, str):
+                return None
+            groups = element.search(line)
+        else:
+            match = element.match([line], fields_in)
+            if match is None or match.before or match.after:
+                return None
+            groups = match.fields
+        if groups is None:
+            return None
+        for key, value in groups.items():
+            if fields_in.get(key, value) != value:
+                return None
+        return groups
+
+    def assign(self, candidate: list, fields_in: dict):
+        """
+        Match our elements to the lines of a candidate OR, in any order.
+        This is a bipartite assignment of elements to lines, where the
+        fields the chosen lines bind must agree.  Elements that can bind
+        new fields are assigned by backtracking, the most constrained
+        first.  After each choice the other elements' options are narrowed
+        to the lines still free and the fields still agreeing, and the
+        choice is dropped unless a bipartite matching of every element
+        left is still possible.  Elements that bind nothing new only need
+        a free line each.
+        :param candidate: The lines of the OR.
+        :param fields_in: The fields bound so far.
+        :return: None, or the fields with those of the match added.
+        """
+        options = []
+        for element in self.elements:
+            found = []
+            for j, line in enumerate(candidate):
+                groups = self.line_fields(element, line, fields_in)
+                if groups is not None:
+                    found.append((j, groups))
+            if not found:
+                return None
+            options.append(found)
+        if not bipartite_match([[j for j, _ in item] for item in options]):
+            return None
+
+        binding = []
+        fixed = []
+        for item in options:
+            if any(key not in fields_in for _, groups in item
+                   for key in groups):
+                binding.append(item)
+            else:
+                fixed.append([j for j, _ in item])
+
+        def search(remaining: list, fields: dict, used: set):
+            # Every option in remaining agrees with fields and is unused.
+            if not remaining:
+                return fields
+            k = min(range(len(remaining)), key=lambda i: len(remaining[i]))
+            rest = remaining[:k] + remaining[k + 1:]
+            for j, groups in remaining[k]:
+                combined = dict(fields)
+                combined.update(groups)
+                taken = used | {j}
+                # Drop the options this choice rules out, and give up on
+                # it as soon as some element is left without a line.
+                narrowed = []
+                for item in rest:
+                    kept = [(i, found) for i, found in item if i not in taken
+                            and all(combined.get(key, value) == value
+                                    for key, value in found.items())]
+                    if not kept:
+                        break
+                    narrowed.append(kept)
+                else:
+                    free = [[i for i, _ in item] for item in narrowed]
+                    free += [[i for i in item if i not in taken]
+                             for item in fixed]
+                    if not bipartite_match(free):
+                        continue
+                    result = search(narrowed, combined, taken)
+                    if result is not None:
+                        return result
+            return None
+
+        return search(binding, dict(fields_in), set())
 
     def match(self, inputs_in: list, fields_in: dict) -> ElementMatch:
         """
@@ -169,48 +323,15 @@ class ElementOR(object):
         :param fields_in:  Source fields to compare.
         :return: None or an ElementMatch object.
         """
-        fields = deepcopy(fields_in)
-
-        # Narrow our possibilities to lists.
-        candidates = {}
-        for i, element in enumerate(inputs_in):
-            if isinstance(element, list):
-                candidates[i] = deepcopy(element)
-
-        for i, candidate in candidates.items():
-            if len(candidate) != len(self.elements):
+        for i, candidate in enumerate(inputs_in):
+            if not isinstance(candidate, list) or \
+                    len(candidate) != len(self.elements):
                 # Can't be an exact match: not the same length
                 continue
-
-            for element in self.elements:
-                match = element.match(candidate, fields)
-                if not match:
-                    # All for one and one for all.
-                    # Since one element didn't match, there is no match.
-                    logging.debug("OR: Element '{}' does not match".format(element))
-                    break
-                combined_fields = combine_dicts(fields, match.fields)
-                if combined_fields is None:
-                    # We found a match, but we have a named parameter that
-                    # holds two different values.  That fails the match.
-                    logging.debug("OR: Element '{}' has conflict".format(element))
-                    logging.debug("match fields = '{}'".format(
-                        pprint.pformat(match.fields)
-                    ))
-                    logging.debug("fields = '{}'".format(
-                        pprint.pformat(fields)
-                    ))
-                    break
-                fields = combined_fields
-                logging.debug("OR: Element '{}' MATCHES".format(element))
-                candidate = match.before + match.after
-
-            if 0 == len(candidate):
-                result = ElementMatch()
-                result.before = inputs_in[:i]
-                result.fields = fields
-                result.after = inputs_in[i+1:]
-                return result
+            fields = self.assign(candidate, fields_in)
+            if fields is not None:
+                logging.debug("OR: %s MATCHES %s", self, LazyFormat(candidate))
+                return ElementMatch(inputs_in[:i], fields, inputs_in[i + 1:])
         return None
 
     def format(self, fields: dict):
@@ -223,7 +344,7 @@ class ElementOR(object):
         for element in self.elements:
             element_fmt = element.format(fields)
             result += element_fmt
-        logging.debug("OR: format {}".format(pprint.pformat(result)))
+        logging.debug("OR: format %s", LazyFormat(result))
         return [result]
 
     def line_count(self) -> int:
@@ -245,9 +366,11 @@ class ElementTemplate(object):
     """
     Another template file used as a trigger or action element.
     """
-    def __init__(self, name):
+    __slots__ = ("name", "path", "elements")
+
+    def __init__(self, name, roots: list):
         self.name = name
-        self.path = get_json_path(name)
+        self.path = get_json_path(name, roots)
         self.elements = []
 
         with open(self.path) as file:
@@ -259,15 +382,15 @@ class ElementTemplate(object):
             if isinstance(element, str):
                 self.elements.append(ElementRegex(element))
             elif isinstance(element, list):
-                self.elements.append(ElementOR(element))
+                self.elements.append(ElementOR(element, roots))
             elif isinstance(element, dict):
                 assert 1 == len(element), "template can only have one dict entry"
                 key, value = next(iter(element.items()))
                 assert {} == value or None == value, \
                     "template dict must be empty: {}".format(value)
-                self.elements.append(ElementTemplate(key))
+                self.elements.append(ElementTemplate(key, roots))
             else:
-                pprint.pprint(element)
+                logging.error("Bad template element %s", LazyFormat(element))
                 assert False, "unknown data type {} in template file".format(
                     type(element)
                 )
@@ -279,10 +402,11 @@ class ElementTemplate(object):
         :param fields_in:  Source fields to compare.
         :return: None or an ElementMatch object.
         """
+        from copy import deepcopy
         input_list = deepcopy(inputs_in)
         elements = self.elements[:]
         fields = deepcopy(fields_in)
-        logging.debug("1: fields={}".format(pprint.pformat(fields)))
+        logging.debug("1: fields=%s", LazyFormat(fields))
 
         for i, element in enumerate(elements):
             logging.debug("{}: Examining {}".format(
@@ -300,46 +424,40 @@ class ElementTemplate(object):
                 # We found a match, but we have a named parameter that
                 # holds two different values.  That fails the match.
                 logging.debug("Element '{}' has field conflict".format(element))
-                logging.debug("match fields = '{}'".format(
-                    pprint.pformat(match.fields)
-                ))
-                logging.debug("fields = '{}'".format(
-                    pprint.pformat(fields)
-                ))
+                logging.debug("match fields = '%s'", LazyFormat(match.fields))
+                logging.debug("fields = '%s'", LazyFormat(fields))
                 return None
             fields = combined_fields
-            logging.debug("2: fields={}".format(pprint.pformat(fields)))
+            logging.debug("2: fields=%s", LazyFormat(fields))
             logging.debug("{}: Element '{}' MATCHES".format(
                 self.name, element))
             input_list = match.before + match.after
 
         result = ElementMatch()
         result.before = []  # Assume templates come first.  *sigh*
-        logging.debug("3: fields={}".format(pprint.pformat(fields)))
+        logging.debug("3: fields=%s", LazyFormat(fields))
         result.fields = fields
         result.after = input_list
 
         # Now, compare what's left with the original list to figure out
         # a good place to split the list.
-        logging.debug("FindLoc: {}".format(pprint.pformat(inputs_in)))
+        logging.debug("FindLoc: %s", LazyFormat(inputs_in))
         for item in inputs_in:
             if 0 == len(result.after):
                 logging.debug("FindLoc: End of results.after")
                 break
             if item == result.after[0]:
                 # Item wasn't taken, it's a "before"
-                logging.debug("FindLoc: Moving {} to results.before".format(
-                    pprint.pformat(result.after[0])
-                ))
+                logging.debug("FindLoc: Moving %s to results.before",
+                              LazyFormat(result.after[0]))
                 result.before.append(result.after[0])
                 result.after = result.after[1:]
             else:
-                logging.debug("FindLoc: End found at '{}'".format(
-                    pprint.pformat(result.after[0])
-                ))
+                logging.debug("FindLoc: End found at '%s'",
+                              LazyFormat(result.after[0]))
                 break
 
-        logging.debug("4: fields={}".format(pprint.pformat(result.fields)))
+        logging.debug("4: fields=%s", LazyFormat(result.fields))
         return result
 
     def format(self, fields: dict):
@@ -352,11 +470,9 @@ class ElementTemplate(object):
         logging.debug("{}: START format".format(self.name))
         for element in self.elements:
             element_fmt = element.format(fields)
-            logging.debug("{}: format {}".format(
-                self.name, pprint.pformat(element_fmt)))
+            logging.debug("%s: format %s", self.name, LazyFormat(element_fmt))
             result += element_fmt
-        logging.debug("{}: END format {}".format(
-            self.name, pprint.pformat(result)))
+        logging.debug("%s: END format %s", self.name, LazyFormat(result))
         return result
 
     def line_count(self) -> int:
@@ -378,13 +494,16 @@ class Substituter(object):
     """
     A Template container.
     """
-    def __init__(self, name):
+    __slots__ = ("template",)
+
+    def __init__(self, name, roots: list):
         """
         Create a Substituter.  This loads the template
         from disk so it can be used.
         :param name: The file name of the template.
+        :param roots: The template directories to search, in order.
         """
-        self.template = ElementTemplate(name)
+        self.template = ElementTemplate(name, roots)
 
     def collapse(self, list_in: list, fields_in: dict) -> (list, dict):
         """
@@ -392,6 +511,7 @@ class Substituter(object):
         list if a match is made.
         :return: The (possibly modified) list.
         """
+        from copy import deepcopy
         match = self.template.match(deepcopy(list_in), fields_in)
         if match is not None:
             replacement = {self.template.name: None}
@@ -402,13 +522,11 @@ class Substituter(object):
         """
         TODO
         """
-        logging.debug("{}: expand {}".format(
-            self.template.name, pprint.pformat(field_data)
-        ))
+        logging.debug("%s: expand %s", self.template.name,
+                      LazyFormat(field_data))
         result = self.template.format(field_data)
-        logging.debug("{}: expanded {}".format(
-            self.template.name, pprint.pformat(result)
-        ))
+        logging.debug("%s: expanded %s", self.template.name,
+                      LazyFormat(result))
 
         return result
 
@@ -0,0 +1,69 @@
+#! /usr/bin/env python3
+"""
+Tests for matching OR groups, run with "python -m pytest tools" or
+"python -m unittest" from the tools directory.
+"""
+import time
+import unittest
+
+from substituter import ElementOR, bipartite_match
+
+
+class TestBipartiteMatch(unittest.TestCase):
+    def test_moves_an_earlier_owner(self):
+        # The first element must give up line 0 for the second.
+        self.assertTrue(bipartite_match([[0, 1], [0]]))
+
+    def test_too_few_lines(self):
+        self.assertFalse(bipartite_match([[0], [0], [0, 1]]))
+
+
+class TestElementOR(unittest.TestCase):
+    def test_general_element_leaves_specific_line(self):
+        # Taken in order, the general element would claim the line the
+        # specific one needs.
+        element = ElementOR(["StateCheck(<T>,<S>)",
+                             "StateCheck(<T>,STATE_SLEEPING)"], [])
+        candidate = ["StateCheck(LastSeenBy(Myself),STATE_SLEEPING)",
+                     "StateCheck(LastSeenBy(Myself),STATE_HELPLESS)"]
+        match = element.match(["ActionListEmpty()", candidate], {})
+        self.assertIsNotNone(match)
+        self.assertEqual({"T": "LastSeenBy(Myself)", "S": "STATE_HELPLESS"},
+                         match.fields)
+        self.assertEqual(["ActionListEmpty()"], match.before)
+        self.assertEqual([], match.after)
+
+    def test_first_line_binding_conflict(self):
+        # Binding TARGET from the first See() line leaves the StateCheck
+        # with nothing that agrees.
+        element = ElementOR(["See(<TARGET>)", "See(<OTHER>)",
+                             "!StateCheck(<TARGET>,STATE_DEAD)"], [])
+        candidate = ["See(NearestEnemyOf(Myself))", "See(Player1)",
+                     "!StateCheck(Player1,STATE_DEAD)"]
+        match = element.match([candidate], {})
+        self.assertIsNotNone(match)
+        self.assertEqual({"TARGET": "Player1",
+                          "OTHER": "NearestEnemyOf(Myself)"}, match.fields)
+
+    def test_fields_bound_before_the_or(self):
+        element = ElementOR(["See(<TARGET>)", "See(<OTHER>)"], [])
+        candidate = ["See(Player1)", "See(Player2)"]
+        match = element.match([candidate], {"TARGET": "Player2"})
+        self.assertEqual({"TARGET": "Player2", "OTHER": "Player1"},
+                         match.fields)
+        self.assertIsNone(element.match([candidate], {"TARGET": "Player3"}))
+
+    def test_wide_unsatisfiable_or_is_fast(self):
+        # The last element must repeat the first one's value, which no
+        # line allows.  Without pruning this tries every permutation.
+        count = 10
+        element = ElementOR(["C(<X{}>)".format(i) for i in range(count - 1)] +
+                            ["C(<X0>)"], [])
+        candidate = ["C(v{})".format(i) for i in range(count)]
+        start = time.perf_counter()
+        self.assertIsNone(element.match([candidate], {}))
+        self.assertLess(time.perf_counter() - start, 0.5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,156 @@
+#! /usr/bin/env python3
+import json
+import logging
+import os
+import re
+
+from combine import convert_json_to_blocks, list_snippets
+from globals import tools_dir
+from registry import TemplateRegistry
+
+# Default scan intervals, by snippet name.
+default_intervals_path = os.path.join(tools_dir, "throttle.json")
+
+# A trigger that makes the engine search for an object.
+_scan_regex = re.compile(r"^\t!?See\(", re.MULTILINE)
+
+_gate_format = "\t!GlobalTimerNotExpired(\"{timer}\",\"LOCALS\")\n"
+
+_arm_format = """IF
+\t!GlobalTimerNotExpired("{timer}","LOCALS")
+{triggers}THEN
+\tRESPONSE #100
+\t\tSetGlobalTimer("{timer}","LOCALS",{interval})
+\t\tContinue()
+END
+
+"""
+
+
+def load_intervals(path: str) -> dict:
+    """
+    Load a table of scan intervals.  Keys are snippet names; "*" applies
+    to every snippet with more than one target-search block.  Values are
+    seconds or timer constants such as ONE_ROUND.
+    :param path: Path to the JSON table.
+    :return: Dict of snippet name to interval.
+    """
+    with open(path) as fp:
+        return json.load(fp)
+
+
+def timer_name(name: str, used: set) -> str:
+    """
+    Make a LOCALS timer name for a snippet that isn't in use yet.
+    :param name: The snippet name.
+    :param used: The timer names already given out (updated).
+    :return: The timer name.
+    """
+    base = "XS_" + re.sub(r"\W|_", "", name)[:24]
+    result = base
+    count = 1
+    while result.upper() in used:
+        count += 1
+        result = "{}_{}".format(base, count)
+    used.add(result.upper())
+    return result
+
+
+def leading_triggers(text: str) -> list:
+    """
+    Split the top of a block into its triggers, up to its first object
+    search.  An OR group counts as one trigger.
+    :param text: The BAF text of the block.
+    :return: A list of trigger texts, each ending with a newline.
+    """
+    result = []
+    for line in text.splitlines(True)[1:]:
+        if line.startswith("\t\t") and result:
+            result[-1] += line
+            continue
+        if not line.startswith("\t") or _scan_regex.match(line):
+            break
+        result.append(line)
+    # An OR group cut short by the search is left out.
+    if result and result[-1].lstrip().startswith("OR(") and \
+            result[-1].count("\n") == 1:
+        result.pop()
+    return result
+
+
+def shared_triggers(texts: list) -> str:
+    """
+    Find the triggers every block of a group checks before searching.
+    ActionListEmpty() is always among them, so a block made of them
+    never interrupts what the player told the creature to do.
+    :param texts: The BAF text of the blocks.
+    :return: The triggers, as BAF text.
+    """
+    result = leading_triggers(texts[0])
+    for text in texts[1:]:
+        other = leading_triggers(text)
+        count = 0
+        while count < min(len(result), len(other)) and \
+                result[count] == other[count]:
+            count += 1
+        result = result[:count]
+    if "ActionListEmpty()" not in (item.strip() for item in result):
+        result.insert(0, "\tActionListEmpty()\n")
+    return "".join(result)
+
+
+def throttle_blocks(texts: list, timer: str, interval) -> list:
+    """
+    Put a group of blocks behind a scan timer.  Each block first checks
+    that the timer has expired, and a block after the group starts the
+    timer again (and lets the script go on) when none of them fired.
+    The group's object searches then run at most once per interval.
+    The restarting block also checks the triggers the group shares ahead
+    of its searches, so the timer restarts only after a scan did run.
+    :param texts: The BAF text of the blocks.
+    :param timer: The LOCALS timer to use.
+    :param interval: The interval, in seconds or as a timer constant.
+    :return: The new list of block texts.
+    """
+    gate = _gate_format.format(timer=timer)
+    result = []
+    for text in texts:
+        assert text.startswith("IF\n"), "Block doesn't start with IF"
+        result.append("IF\n" + gate + text[3:])
+    result.append(_arm_format.format(timer=timer, interval=interval,
+                                     triggers=shared_triggers(texts)))
+    return result
+
+
+def throttle_file(source_dir: str, target_file: str,
+                  registry: TemplateRegistry, intervals: dict) -> int:
+    """
+    Combine snippets, putting the target-search blocks of the snippets
+    named in intervals behind scan timers, one timer per snippet.
+    :param source_dir: The directory holding the snippets.
+    :param target_file: The script to write.
+    :param registry: The templates to expand.
+    :param intervals: Dict of snippet name to interval, see load_intervals.
+    :return: The number of snippets throttled.
+    """
+    used = set()
+    count = 0
+    with open(target_file, "w") as fout:
+        for file in list_snippets(source_dir):
+            with open(file) as fin:
+                snippet = json.load(fin)
+            texts = convert_json_to_blocks(snippet, registry)
+            name = snippet.get("name") or \
+                os.path.splitext(os.path.basename(file))[0]
+            interval = intervals.get(name)
+            scans = sum(1 for text in texts if _scan_regex.search(text))
+            if interval is None and scans > 1:
+                interval = intervals.get("*")
+            if interval is not None and scans:
+                timer = timer_name(name, used)
+                logging.info("Throttling {} ({} blocks) with {}".format(
+                    name, len(texts), timer))
+                texts = throttle_blocks(texts, timer, interval)
+                count += 1
+            fout.write("".join(texts))
+    return count
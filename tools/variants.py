@@ -0,0 +1,144 @@
+#! /usr/bin/env python3
+import json
+import logging
+import os
+import re
+
+from combine import convert_json_to_blocks, list_snippets, snippet_rows
+from commute import parse_trigger
+from globals import tools_dir
+from registry import TemplateRegistry
+from split import parse_if_then
+
+# Which classes and kits can have which spells.
+default_classes_path = os.path.join(tools_dir, "spell_classes.json")
+
+# Variants go below the project, where combine and split don't look.
+variants_dir_name = "variants"
+
+# The spell resource of a row, such as SPWI408.
+_resource_regex = re.compile(r"\b(SP[A-Z]+?)(\d+)\b")
+
+# Triggers that reject a block when the spell isn't known.
+_have_spell = {"HaveSpell", "HaveSpellRES"}
+
+
+class SpellTable(object):
+    """
+    The local spell to class table.
+    attributes:
+    * lists    : Dict of resource prefix (SPWI) to the classes using it
+    * levels   : Dict of class to {prefix: highest spell level}
+    * spells   : Dict of resource (SPCL211) to the classes or kits using it
+    * variants : Dict of variant name to the classes and kits it is for
+    """
+    def __init__(self, path: str):
+        with open(path) as fp:
+            data = json.load(fp)
+        self.lists = data.get("lists", {})
+        self.levels = data.get("levels", {})
+        self.spells = data.get("spells", {})
+        self.variants = data.get("variants", {})
+
+    def usable(self, fields: dict, owners: set) -> bool:
+        """
+        Return False if a row casts a spell none of owners can have.
+        Rows with no spell, or a spell the table doesn't know, are kept.
+        :param fields: The field values of the row.
+        :param owners: The classes and kits of the variant.
+        :return: True if the row may be of use.
+        """
+        m = None
+        for key in ("SPELL", "DESC"):
+            m = _resource_regex.search(fields.get(key, ""))
+            if m:
+                break
+        if m is None:
+            return True
+        prefix, number = m.groups()
+        resource = prefix + number
+        if resource in self.spells:
+            return bool(owners.intersection(self.spells[resource]))
+        if prefix not in self.lists:
+            return True
+        level = int(number[0]) if number else 0
+        for owner in owners.intersection(self.lists[prefix]):
+            if level <= self.levels.get(owner, {}).get(prefix, 9):
+                return True
+        return False
+
+
+def rejected_cost(text: str, costs: dict) -> (int, float):
+    """
+    Estimate what the engine spends on a block before HaveSpell rejects
+    it: every trigger up to and including the spell check.
+    :param text: The BAF text of the block.
+    :param costs: Dict of trigger name to relative cost, with "default".
+    :return: (triggers evaluated, relative cost).
+    """
+    count = 0
+    cost = 0.0
+    for item in parse_if_then(text)["IF"]:
+        for line in item if isinstance(item, list) else [item]:
+            parsed = parse_trigger(line)
+            name = parsed[1] if parsed else None
+            count += 1
+            cost += costs.get(name, costs["default"])
+            if name in _have_spell:
+                return count, cost
+    return count, cost
+
+
+def write_variants(source_dir: str, registry: TemplateRegistry,
+                   table: SpellTable, costs: dict, names: list = None) -> dict:
+    """
+    Write the class variants of a script to the variants directory, as
+    <script>_<variant>.BAF.  Blocks casting spells the variant can't
+    have are left out.
+    :param source_dir: The directory holding the snippets.
+    :param registry: The templates to expand.
+    :param table: The spell table.
+    :param costs: Dict of trigger name to relative cost, with "default".
+    :param names: The variants to write (default: all in the table).
+    :return: Dict of variant name to (blocks kept, keys of the blocks
+    removed, triggers saved, cost saved).  A block key is the snippet
+    file and row, as in commute.load_blocks, followed by the snippet name:
+    "0640-Cast-Spell:3 (Cast-Spell)".
+    """
+    rows = []
+    for file in list_snippets(source_dir):
+        with open(file) as fp:
+            snippet = json.load(fp)
+        texts = convert_json_to_blocks(snippet, registry)
+        stem = os.path.splitext(os.path.basename(file))[0]
+        keys = ["{}:{} ({})".format(stem, row, snippet.get("name", stem))
+                for row in range(len(texts))]
+        rows += zip(snippet_rows(snippet), texts, keys)
+
+    target_dir = os.path.join(os.path.dirname(source_dir), variants_dir_name)
+    os.makedirs(target_dir, exist_ok=True)
+    script = os.path.basename(source_dir)
+    result = {}
+    for name, owners in table.variants.items():
+        if names and name not in names:
+            continue
+        owners = set(owners)
+        kept = []
+        removed = []
+        triggers = 0
+        cost = 0.0
+        for fields, text, key in rows:
+            if table.usable(fields, owners):
+                kept.append(text)
+                continue
+            removed.append(key)
+            count, weight = rejected_cost(text, costs)
+            triggers += count
+            cost += weight
+        target = os.path.join(target_dir, "{}_{}.BAF".format(script, name))
+        logging.info("Writing '{}'".format(target))
+        with open(target, "w") as fp:
+            fp.write("".join(kept))
+        result[name] = (len(kept), removed, triggers, cost)
+    return result
+
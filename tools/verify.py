@@ -0,0 +1,222 @@
+#! /usr/bin/env python3
+import argparse
+import collections
+import logging
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+from combine import convert_json_to_blocks
+from corpus import find_scripts
+from globals import tools_dir, project_name
+from registry import TemplateRegistry
+from split import block_templates, iter_collapse, iter_statements, \
+    parse_if_then, replace_double_quotes_with_single_outside_comment
+from substituter import ElementOR, ElementRegex
+
+# Registries already loaded by this process, by template root.
+_registries = {}
+
+
+def normalize(text: str) -> list:
+    """
+    Reduce a block to what split and combine must keep: its non-blank
+    lines, stripped, with quotes outside comments made single.
+    :param text: The BAF text of the block.
+    :return: A list of lines.
+    """
+    text = replace_double_quotes_with_single_outside_comment(text)
+    return [line.strip() for line in text.split("\n") if line.strip()]
+
+
+def line_template(line: str, names: list, registry: TemplateRegistry):
+    """
+    Find which template a line of a block comes from.
+    :param line: The normalized line.
+    :param names: The templates the block uses.
+    :param registry: The templates.
+    :return: The name of the innermost template with an element
+    matching the line, or None.
+    """
+    def search(template):
+        for element in template.elements:
+            for item in element.elements if isinstance(element, ElementOR) \
+                    else [element]:
+                if isinstance(item, ElementRegex):
+                    if item.search(line) is not None:
+                        return template.name
+                else:
+                    found = search(item)
+                    if found:
+                        return found
+        return None
+
+    for name in names:
+        found = search(registry.substituter(name).template)
+        if found:
+            return found
+    return None
+
+
+def first_difference(expected: list, actual: list):
+    """
+    :return: (line number, expected line, actual line) of the first
+    difference between two lists of lines, or None.
+    """
+    for i in range(max(len(expected), len(actual))):
+        left = expected[i] if i < len(expected) else "<missing>"
+        right = actual[i] if i < len(actual) else "<missing>"
+        if left != right:
+            return i + 1, left, right
+    return None
+
+
+def verify_script(job: tuple) -> dict:
+    """
+    Stream one script through parse, collapse and render, comparing each
+    rendered block with the statement it came from.  Stops at the first
+    block that differs.
+    :param job: (script path, template root).
+    :return: A dict with "script", "blocks", "seconds" and "error" (None,
+    or a dict describing the first divergence).
+    """
+    path, root = job
+    start = time.perf_counter()
+    try:
+        registry = _registries[root]
+    except KeyError:
+        registry = _registries[root] = TemplateRegistry.load(root)
+
+    pending = collections.deque()
+
+    def statements(fp):
+        for index, text in enumerate(iter_statements(fp)):
+            pending.append((index, text))
+            yield parse_if_then(text, "{} block {}".format(path, index))
+
+    result = {"script": path, "blocks": 0, "error": None}
+    with open(path, errors="replace") as fp:
+        for snippet in iter_collapse(statements(fp), registry):
+            # A snippet is yielded once the statement after it is read.
+            count = len(snippet["fields"])
+            for row, text in enumerate(
+                    convert_json_to_blocks(snippet, registry)):
+                index, source = pending.popleft()
+                expected = normalize(source)
+                actual = normalize(text)
+                if expected != actual:
+                    line, left, right = first_difference(expected, actual)
+                    names = block_templates(snippet)
+                    result["error"] = {
+                        "block": index + 1,
+                        "name": snippet.get("name"),
+                        "row": "{} of {}".format(row + 1, count),
+                        "templates": names,
+                        "source": line_template(left, names, registry) or
+                        line_template(right, names, registry),
+                        "line": line,
+                        "expected": left,
+                        "actual": right,
+                    }
+                    result["blocks"] = index
+                    result["seconds"] = time.perf_counter() - start
+                    return result
+                result["blocks"] += 1
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+def verify(scripts: list, root: str, jobs: int = None) -> list:
+    """
+    Verify scripts in parallel.
+    :param scripts: The script paths.
+    :param root: The template root for every script.
+    :param jobs: The number of processes (default: one per CPU).
+    :return: The verify_script results, largest scripts first.
+    """
+    # Largest first, so one big script doesn't finish last on its own.
+    scripts = sorted(scripts, key=os.path.getsize, reverse=True)
+    # Build the template cache once, before the workers read it.
+    TemplateRegistry.load(root)
+    work = [(path, root) for path in scripts]
+    if 1 == jobs or len(work) < 2:
+        return [verify_script(item) for item in work]
+    with multiprocessing.Pool(jobs) as pool:
+        return pool.map(verify_script, work, chunksize=1)
+
+
+def report(results: list) -> bool:
+    """
+    Print the results.
+    :return: True if every script round-tripped.
+    """
+    ok = True
+    for result in results:
+        error = result["error"]
+        if error is None:
+            logging.info("{}: {} blocks OK ({:.2f}s)".format(
+                result["script"], result["blocks"], result["seconds"]))
+            continue
+        ok = False
+        print("{}: block {} ({}, row {}) differs".format(
+            result["script"], error["block"], error["name"] or "<unnamed>",
+            error["row"]))
+        print("    templates: {}".format(", ".join(error["templates"]) or
+                                         "<none>"))
+        if error["source"]:
+            print("    line from template {}".format(error["source"]))
+        print("    line {}: expected {}".format(error["line"],
+                                               error["expected"]))
+        print("    line {}: rendered {}".format(error["line"],
+                                               error["actual"]))
+    blocks = sum(result["blocks"] for result in results)
+    print("{} scripts, {} blocks, {}".format(
+        len(results), blocks, "OK" if ok else "FAILED"))
+    return ok
+
+
+if __name__ == "__main__":
+    search_dir = os.path.join(tools_dir, "..", project_name)
+    parser = argparse.ArgumentParser(
+        description="Check that scripts survive split and combine")
+    parser.add_argument('-v', '--verbose', action='count', default=0)
+    parser.add_argument('-d', '--search_dir', default=search_dir)
+    parser.add_argument('-t', '--templates',
+                        help="Directory holding if/then (default: search_dir)")
+    parser.add_argument('-j', '--jobs', type=int,
+                        help="Processes to use (default: one per CPU)")
+    parser.add_argument('-g', '--generate', type=int, metavar="LINES",
+                        help="Verify a generated corpus of this many lines, "
+                             "built from the statements of search_dir")
+    parser.add_argument('paths', nargs='*',
+                        help="Scripts or directories (default: search_dir)")
+
+    args = parser.parse_args()
+    if args.verbose == 0:
+        level = logging.WARNING
+    elif args.verbose == 1:
+        level = logging.INFO
+    else:
+        level = logging.DEBUG
+    logging.basicConfig(stream=sys.stdout, level=level)
+
+    root = args.templates or args.search_dir
+    start = time.perf_counter()
+    if args.generate:
+        from bench_corpus import generate_corpus, load_statements
+        with tempfile.TemporaryDirectory() as temp_dir:
+            lines = generate_corpus(temp_dir, load_statements(args.search_dir),
+                                    args.generate)
+            logging.warning("Generated {} lines".format(lines))
+            results = verify(find_scripts([temp_dir]), root, args.jobs)
+    else:
+        scripts = [os.path.join(args.search_dir, name)
+                   for name in sorted(os.listdir(args.search_dir))
+                   if name.lower().endswith(".baf")]
+        results = verify(find_scripts(args.paths) if args.paths else scripts,
+                         root, args.jobs)
+    ok = report(results)
+    logging.warning("Verified in {:.2f}s".format(time.perf_counter() - start))
+    sys.exit(0 if ok else 1)